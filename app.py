@@ -7,15 +7,20 @@ import os.path as osp
 import fitz  # PyMuPDF for PDF preview
 import shutil
 from streamlit import session_state as ss
-import sqlite3
+import time
 from datetime import datetime
+from utils import get_file_hash
+from database import (get_db_connection, add_column_if_missing, get_summary_version, init_blob_table,
+                      put_texts, migrate_to_blobs)
+from jobs import init_job_tables, submit_job, get_job, find_active_job, get_job_chunks, get_upload_path
+from search import init_search_index, drop_outdated_search_index, search
 
 def init_db():
     """Initialize SQLite database with required tables"""
-    conn = sqlite3.connect('books.db')
-
     ss.db_file = 'books.db'
 
+    conn = get_db_connection(ss.db_file)
+
     c = conn.cursor()
     
     # Create books table
@@ -26,6 +31,7 @@ def init_db():
             book_name TEXT,
             total_pages INTEGER,
             created_at TIMESTAMP,
+            content_hash TEXT,
             UNIQUE(book_name, author)
         )
     ''')
@@ -37,6 +43,8 @@ def init_db():
             book_id INTEGER,
             chunk_text TEXT,
             chunk_order INTEGER,
+            chunk_title TEXT,
+            text_hash TEXT,
             FOREIGN KEY (book_id) REFERENCES books (id)
         )
     ''')
@@ -48,6 +56,9 @@ def init_db():
             book_id INTEGER,
             summary_style TEXT,
             created_at TIMESTAMP,
+            prompt_hash TEXT,
+            routing_hash TEXT,
+            content_hash TEXT,
             FOREIGN KEY (book_id) REFERENCES books (id)
         )
     ''')
@@ -59,12 +70,52 @@ def init_db():
             summary_id INTEGER,
             chunk_order INTEGER,
             chunk_summary TEXT,
+            summary_hash TEXT,
             FOREIGN KEY (summary_id) REFERENCES summaries (id),
             FOREIGN KEY (chunk_order) REFERENCES chunks (id)
         )
     ''')
+
+    # columns added after the first release
+    add_column_if_missing(c, 'books', 'content_hash', 'TEXT')
+    add_column_if_missing(c, 'summaries', 'prompt_hash', 'TEXT')
+    add_column_if_missing(c, 'summaries', 'routing_hash', 'TEXT')
+    add_column_if_missing(c, 'summaries', 'content_hash', 'TEXT')
+    add_column_if_missing(c, 'chunks', 'chunk_title', 'TEXT')
+    add_column_if_missing(c, 'chunks', 'text_hash', 'TEXT')
+    add_column_if_missing(c, 'chunk_summaries', 'summary_hash', 'TEXT')
+
+    # drop the duplicate chunk rows that earlier versions inserted on every upload,
+    # so that (book_id, chunk_order) can be unique
+    c.execute('''
+        DELETE FROM chunks WHERE id NOT IN (
+            SELECT MIN(id) FROM chunks GROUP BY book_id, chunk_order
+        )
+    ''')
+    # also serves lookups by book_id, as its leading column
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_book_order ON chunks (book_id, chunk_order)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chunk_summaries_summary ON chunk_summaries (summary_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_books_content_hash ON books (content_hash)')
+    c.execute('DROP INDEX IF EXISTS idx_summaries_lookup')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_summaries_version
+        ON summaries (book_id, summary_style, content_hash, prompt_hash, routing_hash)
+    ''')
     
     conn.commit()
+
+    # texts are stored compressed, once, in blobs referenced by their hash
+    init_blob_table(conn)
+    # the search index of earlier versions is rebuilt after their inline texts are moved to blobs
+    drop_outdated_search_index(conn)
+    report = migrate_to_blobs(conn)
+    if report['chunks'] + report['chunk_summaries'] > 0:
+        print(f"Moved {report['chunks']} chunk texts and {report['chunk_summaries']} chunk summaries "
+              f"({report['inline_bytes']} bytes) to blobs of {report['blob_bytes']} bytes")
+
+    # summaries are generated by the workers of jobs.py
+    init_job_tables(conn)
+    init_search_index(conn)
     conn.close()
 
 def init_session_state():
@@ -89,6 +140,10 @@ def init_session_state():
         ss.book_info_updated = False
     if 'book_id' not in ss:
         ss.book_id = None
+    if 'content_hash' not in ss:
+        ss.content_hash = None
+    if 'job_id' not in ss:
+        ss.job_id = None
 
 def update_summary_options():
     with st.sidebar:
@@ -100,6 +155,11 @@ def update_summary_options():
             index=style_options.index(ss.summary_style) if ss.summary_style in style_options else 0,
             help="\n\n".join([f"**{k}**: {v['description']}" for k, v in SUMMARY_STYLES.items()])
         )
+        if selected_style != ss.summary_style:
+            # the summary and job shown belong to the previous style
+            ss.summary = None
+            ss.summary_json = None
+            ss.job_id = None
         ss.summary_style = selected_style
         st.markdown(f"**Description:** {SUMMARY_STYLES[selected_style]['description']}")
 
@@ -118,6 +178,8 @@ def update_uploaded_file(uploaded_file):
         # Store in session state
         ss.uploaded_file = doc
         ss.temp_path = temp_path
+        # books are identified by their content, whatever the file is called
+        ss.content_hash = get_file_hash(temp_path)
     else:
         # reset session state
         ss.uploaded_file = None
@@ -129,6 +191,8 @@ def update_uploaded_file(uploaded_file):
         ss.book_info_updated = False
         ss.summary_updated = False
         ss.book_id = None
+        ss.content_hash = None
+        ss.job_id = None
 
 def update_book_info():
     with st.sidebar:
@@ -159,133 +223,231 @@ def update_book_info():
 def update_book_info_to_db():
     # if book info updated is false and uploaded file is not none
     if ss.book_info_updated is False and ss.uploaded_file is not None:
-        conn = sqlite3.connect('books.db')
-        c = conn.cursor()
+        conn = get_db_connection(ss.db_file)
         
         # update book info updated
         ss.book_info_updated = True
 
-        book_id = None
-
         try:
-            # Insert book information
-            c.execute('''
-                INSERT INTO books (author, book_name, total_pages, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                ss.uploaded_file.author,
-                ss.uploaded_file.name,
-                ss.doc_stats['total_pages'],
-                datetime.now()
-            ))
-
-            # update book_id
-            ss.book_id = c.lastrowid
-
-            conn.commit()
-        
-        # if book already exists
-        except sqlite3.IntegrityError:
-            ss.book_id = c.execute('''
-                SELECT id FROM books WHERE book_name = ? AND author = ?
-            ''', (ss.uploaded_file.name, ss.uploaded_file.author)).fetchone()[0]
-            conn.rollback()
+            # book and chunks are written in one transaction
+            with conn:
+                # a book is found by its content hash first, then by name and author
+                row = conn.execute('''
+                    SELECT id FROM books WHERE content_hash = ?
+                ''', (ss.content_hash,)).fetchone()
+
+                if row is None:
+                    # Insert book information, if the book already exists keep it
+                    conn.execute('''
+                        INSERT INTO books (author, book_name, total_pages, created_at, content_hash)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (book_name, author) DO UPDATE SET content_hash = excluded.content_hash
+                    ''', (
+                        ss.uploaded_file.author,
+                        ss.uploaded_file.name,
+                        ss.doc_stats['total_pages'],
+                        datetime.now(),
+                        ss.content_hash
+                    ))
+
+                    row = conn.execute('''
+                        SELECT id FROM books WHERE book_name = ? AND author = ?
+                    ''', (ss.uploaded_file.name, ss.uploaded_file.author)).fetchone()
+
+                # update book_id
+                ss.book_id = row[0]
+
+                # update book chunks, uploading a known book again only refreshes their text
+                chunks = ss.uploaded_file.contents
+                hashes = put_texts(conn, [chunk['text'] for chunk in chunks.values()])
+                conn.executemany('''
+                    INSERT INTO chunks (book_id, chunk_order, text_hash, chunk_title)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (book_id, chunk_order) DO UPDATE SET
+                        text_hash = excluded.text_hash, chunk_title = excluded.chunk_title
+                ''', [(ss.book_id, int(chunk_id), text_hash, chunks[chunk_id]['title'])
+                      for chunk_id, text_hash in zip(chunks, hashes)])
+                # a new version with fewer chunks drops the others, and the triggers their search index entries
+                conn.execute('''
+                    DELETE FROM chunks WHERE book_id = ? AND chunk_order >= ?
+                ''', (ss.book_id, len(chunks)))
         finally:
-            chunks = ss.uploaded_file.contents
-            for chunk_id in chunks:
-                # update book chunks
-                c.execute('''
-                    INSERT INTO chunks (book_id, chunk_order, chunk_text)
-                    VALUES (?, ?, ?)
-                ''', (
-                    ss.book_id,
-                    int(chunk_id),
-                    chunks[chunk_id]['text']
-                ))
-                conn.commit()
             conn.close()
+
+
+def get_current_summary_version():
+    """Hashes of the prompt and the model routing a summary of the current style depends on"""
+    return get_summary_version(config, SUMMARY_STYLES[ss.summary_style]["prompt_file"])
+
+def load_summary_from_db():
+    """
+    Rebuild the summary of the current book and style from the database, if one was
+    generated from the same edition of the book, with the same prompt and model routing.
+    Returns None otherwise.
+    """
+    prompt_hash, routing_hash = get_current_summary_version()
+    conn = get_db_connection(ss.db_file)
+    try:
+        row = conn.execute('''
+            SELECT id FROM summaries
+            WHERE book_id = ? AND summary_style = ? AND content_hash = ? AND prompt_hash = ? AND routing_hash = ?
+            ORDER BY created_at DESC LIMIT 1
+        ''', (ss.book_id, ss.summary_style, ss.content_hash, prompt_hash, routing_hash)).fetchone()
+        if row is None:
+            return None
+
+        chunk_summaries = dict(conn.execute('''
+            SELECT cs.chunk_order, decompress_text(b.data)
+            FROM chunk_summaries cs JOIN blobs b ON b.hash = cs.summary_hash
+            WHERE cs.summary_id = ?
+        ''', (row[0],)).fetchall())
+    finally:
+        conn.close()
+
+    # titles, levels and texts come from the parsed document, the summaries from the database
+    chunks = ss.uploaded_file.contents
+    if any(int(chunk_id) not in chunk_summaries for chunk_id in chunks):
+        return None
+    return {chunk_id: dict(chunk, summary=chunk_summaries[int(chunk_id)]) for chunk_id, chunk in chunks.items()}
+
+def update_search():
+    with st.expander("Search the library"):
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            query = st.text_input("Search books and summaries", placeholder="e.g. compound interest")
+        with col2:
+            target = st.radio("Search in", ['summaries', 'chunks'],
+                              format_func=lambda e: "Summaries" if e == 'summaries' else "Book text")
+
+        if query.strip() == '':
             return
 
+        conn = get_db_connection(ss.db_file)
+        try:
+            hits = search(conn, query, target=target, highlight=('**', '**'))
+        finally:
+            conn.close()
+
+        if len(hits) == 0:
+            st.write("No results.")
+        for hit in hits:
+            style = f" · {hit['summary_style']}" if hit['summary_style'] else ''
+            st.markdown(f"**{hit['book']}** · {hit['title']}{style}\n\n{hit['snippet']}")
+
+def submit_summary_job():
+    """Queue the current book and style for the workers and return the job id"""
+    # workers read the book from a path that outlives the session and later uploads
+    doc_path = get_upload_path(config, ss.content_hash, osp.basename(ss.temp_path))
+    if not osp.exists(doc_path):
+        shutil.copyfile(ss.temp_path, doc_path)
+
+    conn = get_db_connection(ss.db_file)
+    try:
+        return submit_job(conn, ss.book_id, ss.content_hash, doc_path, ss.summary_style,
+                          SUMMARY_STYLES[ss.summary_style]["prompt_file"])
+    finally:
+        conn.close()
+
+def display_summary(summary, height=600):
+    # Convert the first line to a proper header if it starts with #
+    summary_lines = summary.split('\n')
+    if summary_lines and summary_lines[0].startswith('#'):
+        summary_lines[0] = f"<h1>{summary_lines[0].lstrip('#').strip()}</h1>"
+    
+    cleaned_summary = '\n'.join(summary_lines)
+    
+    st.markdown(
+        f"""
+        <div style="height: {height}px; overflow-y: auto; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
+            {cleaned_summary}
+        """,
+        unsafe_allow_html=True
+    )
+
+def update_job_progress():
+    """
+    Show the progress and finished sections of the summary job, polling until it is done.
+    """
+    conn = get_db_connection(ss.db_file)
+    try:
+        job = get_job(conn, ss.job_id)
+        job_chunks = get_job_chunks(conn, ss.job_id)
+    finally:
+        conn.close()
+
+    if job['status'] == 'done':
+        ss.job_id = None
+        summary_data = load_summary_from_db()
+        if summary_data is not None:
+            ss.summary_json = summary_data
+            ss.summary = Summarizer(config).format_doc_summary(summary_data)
+        return
+
+    if job['status'] == 'failed':
+        ss.job_id = None
+        st.error(f"Summary generation failed: {job['error']}")
+        return
+
+    if job['status'] == 'queued':
+        st.info("Summary queued, waiting for a worker (start one with `python jobs.py`)...")
+    else:
+        total = job['total_chunks'] or 0
+        st.progress(job['done_chunks'] / total if total > 0 else 0.0,
+                    text=f"Summarized {job['done_chunks']} of {total} sections...")
+
+    if len(job_chunks) > 0:
+        st.header("Document Summary (in progress)")
+        with st.container():
+            display_summary(Summarizer(config)._format_chunks(job_chunks))
+
+    time.sleep(config['JOBS']['POLL_INTERVAL'])
+    st.rerun()
 
 def update_summary():
     if ss.uploaded_file is not None:
+        regenerate = st.checkbox("Regenerate summary",
+                                 help="Generate a new summary even if one of this style is already stored")
         if st.button("Generate Summary"):
-            # generate summary
-            with st.spinner("Generating summary..."):
-                summarizer = Summarizer(config)
-                summary_data = summarizer._get_doc_summary(
-                    document=ss.uploaded_file,
-                    summary_prompt_path=osp.join(
-                        config["PROMPT_DIR"],
-                        SUMMARY_STYLES[ss.summary_style]["prompt_file"]
-                    ),
-                    save=False
-                )
-                ss.summary_json = summary_data
-                ss.summary = summarizer.format_doc_summary(summary_data)
-
-                update_summary_to_db()
-                
-                # # Store book information in database
-                # if store_book_info(ss.uploaded_file, ss.summary_style, summary_data):
-                #     st.success("Book information stored successfully!")
-                # else:
-                #     st.warning("Book already exists in database!")
+            summary_data = None if regenerate else load_summary_from_db()
 
+            if summary_data is not None:
+                ss.summary_json = summary_data
+                ss.summary = Summarizer(config).format_doc_summary(summary_data)
+                st.info("Loaded the stored summary, tick \"Regenerate summary\" to generate a new one.")
+            else:
+                # generated in the background by the workers, the page only polls the job
+                ss.summary = None
+                ss.summary_json = None
+                ss.job_id = submit_summary_job()
+
+        # pick up a job submitted before a reload or by another session
+        if ss.job_id is None and ss.summary is None and ss.book_id is not None:
+            conn = get_db_connection(ss.db_file)
+            try:
+                job = find_active_job(conn, ss.book_id, ss.content_hash, ss.summary_style)
+            finally:
+                conn.close()
+            if job is not None:
+                ss.job_id = job['id']
+
+        if ss.job_id is not None:
+            update_job_progress()
+
+        if ss.summary is not None:
             # display summary
             st.header("Document Summary")
             with st.container():
-                # Convert the first line to a proper header if it starts with #
-                summary_lines = st.session_state.summary.split('\n')
-                if summary_lines and summary_lines[0].startswith('#'):
-                    summary_lines[0] = f"<h1>{summary_lines[0].lstrip('#').strip()}</h1>"
-                
-                cleaned_summary = '\n'.join(summary_lines)
-                
-                st.markdown(
-                    f"""
-                    <div style="height: 600px; overflow-y: auto; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
-                        {cleaned_summary}
-                    """,
-                    unsafe_allow_html=True
-                )
+                display_summary(ss.summary)
 
             st.write("   ") 
 
             st.download_button(
                 label="Download Summary",
-                data=st.session_state.summary,
-                file_name=f"{st.session_state.uploaded_file.name}_summary.md",
+                data=ss.summary,
+                file_name=f"{ss.uploaded_file.name}_summary.md",
                 mime="text/markdown"
             )
 
-def update_summary_to_db():
-    # if ss.summary_updated is False and ss.summary_json is not None:
-    # Insert summary
-    conn = sqlite3.connect(ss.db_file)
-    c = conn.cursor()
-    
-    # insert summary event
-    c.execute('''
-        INSERT INTO summaries (book_id, summary_style, created_at)
-        VALUES (?, ?, ?)
-    ''', (ss.book_id, ss.summary_style, datetime.now()))
-
-    summary_id = c.lastrowid
-
-    # insert chunk summaries
-    for chunk_id in ss.summary_json:
-        c.execute('''
-            INSERT INTO chunk_summaries (summary_id, chunk_order, chunk_summary)
-            VALUES (?, ?, ?)
-        ''', (summary_id, chunk_id, ss.summary_json[chunk_id]['summary']))
-    
-    conn.commit()
-    conn.close()
-
-    ss.summary_updated = True
-    return
-
 
 if __name__ == '__main__':
     # --- Summary Style Definitions ---
@@ -324,6 +486,8 @@ if __name__ == '__main__':
 
     # initialize session state
     init_session_state()
+    # search the library
+    update_search()
     # update summary options
     update_summary_options()
     # update uploaded file
@@ -0,0 +1,108 @@
+import json
+import os.path as osp
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from document import PDF_Document
+from summarizer import Summarizer, get_summary_prompt_path
+from text_to_speech import TextToSpeech, get_mp3_file_duration
+from utils import mkdir_if_not_exists
+
+
+class Audiobook:
+    """
+    Summarize a book and narrate it chapter by chapter. Speech for a chapter is generated
+    in the background as soon as its chunk summaries are done, while the next chapters
+    are still being summarized.
+    """
+    def __init__(self, config, max_workers: int = 2):
+        self.config = config
+        self.summarizer = Summarizer(config=config)
+        self.text_to_speech = TextToSpeech(config)
+        # chapters synthesized at the same time, each chapter also synthesizes its pieces concurrently
+        self.max_workers = max_workers
+
+    def _synthesize_chapter(self, index: int, chapter_summaries: dict, output_dir: str, voice: str,
+                            use_cache: bool) -> dict:
+        first_chunk = next(iter(chapter_summaries.values()))
+        text = self.summarizer._format_chunks(chapter_summaries)
+
+        # the chapter is written as its audio arrives, and is playable while it is written
+        file_name = f'chapter_{index:03d}.mp3'
+        output_path = self.text_to_speech.stream_speech(text=text, output_dir=output_dir, voice=voice,
+                                                        use_cache=use_cache, file_name=file_name)
+        print(f"Saved chapter {index}: {first_chunk['title']}")
+
+        return {
+            'index': index,
+            'title': first_chunk['title'],
+            'file': file_name,
+            'duration': get_mp3_file_duration(output_path),
+            'chunk_ids': list(chapter_summaries.keys()),
+        }
+
+    def generate(self, document: PDF_Document, summary_style: str = 'analytic', voice: str = 'alloy',
+                 incremental: bool = True, use_cache: bool = True) -> dict:
+        """
+        Generate the audiobook of a document: one audio file per top-level chapter and an
+        audiobook.json index with the chapter manifest and durations.
+
+        Returns:
+            dict: The audiobook index
+        """
+        start = time.time()
+        output_dir = mkdir_if_not_exists(osp.join(document.save_dir, f'audiobook_{summary_style}_{voice}'))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = []
+
+        def on_chapter(chapter_summaries):
+            futures.append(executor.submit(self._synthesize_chapter, len(futures) + 1, chapter_summaries,
+                                           output_dir, voice, use_cache))
+
+        try:
+            self.summarizer._get_doc_summary(document=document,
+                                             summary_prompt_path=get_summary_prompt_path(self.config, summary_style),
+                                             save=True,
+                                             summary_style=summary_style,
+                                             incremental=incremental,
+                                             on_chapter=on_chapter)
+            summarized = time.time() - start
+            chapters = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        index = {
+            'book': document.name,
+            'author': document.author,
+            'summary_style': summary_style,
+            'voice': voice,
+            'duration': sum(e['duration'] for e in chapters),
+            'chapters': chapters,
+        }
+        with open(osp.join(output_dir, 'audiobook.json'), 'w') as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+
+        print(f'Summarized in {summarized:.1f}s, audiobook of {len(chapters)} chapters '
+              f'({index["duration"] / 60:.1f} min) done in {time.time() - start:.1f}s, saved to {output_dir}')
+        return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Book summary audiobook")
+    parser.add_argument('--style', type=str, default='analytic', help='summary style')
+    parser.add_argument('--doc_path', type=str, required=True, help='document path')
+    parser.add_argument('--voice', type=str, default='alloy', help='voice used for speech generation')
+    parser.add_argument('--full', action='store_true', help='re-summarize every chunk instead of reusing unchanged ones')
+    parser.add_argument('--no_cache', action='store_true', help='synthesize every piece again instead of reusing cached audio')
+
+    args = parser.parse_args()
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    doc = PDF_Document(file_path=args.doc_path, config=config)
+
+    audiobook = Audiobook(config)
+    audiobook.generate(doc, summary_style=args.style, voice=args.voice,
+                       incremental=not args.full, use_cache=not args.no_cache)
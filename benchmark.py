@@ -0,0 +1,303 @@
+import json
+import os
+import os.path as osp
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import argparse
+import multiprocessing
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import fitz
+import numpy as np
+from fake_openai_server import run_server
+from utils import mkdir_if_not_exists
+
+PIPELINES = ['summarize', 'evaluate', 'tts']
+
+VOCABULARY = ('habit system identity change process outcome behavior routine reward craving cue '
+              'environment progress plateau improvement success failure practice skill mastery '
+              'decision motivation discipline focus attention goal result effort time money value '
+              'people team work career learning knowledge experience strategy risk growth').split()
+CONNECTORS = ['the', 'a', 'of', 'to', 'and', 'in', 'that', 'is', 'for', 'with', 'as', 'on', 'by']
+
+
+def get_synthetic_text(rng, n_words):
+    words = []
+    while len(words) < n_words:
+        sentence = [rng.choice(VOCABULARY if i % 2 == 0 else CONNECTORS) for i in range(rng.randint(8, 20))]
+        words.extend([sentence[0].capitalize()] + sentence[1:-1] + [sentence[-1] + '.'])
+    return ' '.join(words[:n_words])
+
+
+def make_synthetic_book(path, n_chapters, words_per_chapter, seed=0):
+    """
+    Write a PDF book with a table of contents, one chapter of generated prose per entry.
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    toc = []
+    for chapter in range(n_chapters):
+        text = get_synthetic_text(rng, words_per_chapter)
+        toc.append([1, f'Chapter {chapter + 1}: The {rng.choice(VOCABULARY).capitalize()} Principle', len(doc) + 1])
+        # about 350 words fit on a page
+        words = text.split()
+        for i in range(0, len(words), 350):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(72, 72, page.rect.width - 72, page.rect.height - 72),
+                                ' '.join(words[i:i + 350]), fontsize=10)
+    doc.set_metadata({'author': 'Benchmark Author', 'title': osp.basename(path)[:-4]})
+    doc.set_toc(toc)
+    doc.save(path)
+    doc.close()
+
+
+def _instrument_httpx(calls):
+    """
+    Record the path, status and duration of every HTTP request the OpenAI clients send,
+    retries included.
+    """
+    import httpx
+    sync_send, async_send = httpx.Client.send, httpx.AsyncClient.send
+
+    def send(self, request, **kwargs):
+        start, status = time.perf_counter(), 'error'
+        try:
+            response = sync_send(self, request, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            calls.append((request.url.path, status, time.perf_counter() - start))
+
+    async def a_send(self, request, **kwargs):
+        start, status = time.perf_counter(), 'error'
+        try:
+            response = await async_send(self, request, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            calls.append((request.url.path, status, time.perf_counter() - start))
+
+    httpx.Client.send, httpx.AsyncClient.send = send, a_send
+
+
+def get_latency_stats(latencies):
+    if len(latencies) == 0:
+        return None
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': max(latencies) * 1000}
+
+
+def get_call_stats(calls):
+    """Per-endpoint call counts, statuses and latency percentiles of the successful calls"""
+    stats = {}
+    for path in sorted({e[0] for e in calls}):
+        path_calls = [e for e in calls if e[0] == path]
+        status = {}
+        for _, code, _ in path_calls:
+            status[str(code)] = status.get(str(code), 0) + 1
+        stats[path] = {
+            'calls': len(path_calls),
+            'status': status,
+            'latency': get_latency_stats([e[2] for e in path_calls if e[1] == 200]),
+        }
+    return stats
+
+
+def run_pipeline(pipeline, config, doc_paths, summary_style, max_concurrency):
+    """
+    Run one pipeline on the synthetic books, in a fresh process so that its peak memory
+    is its own.
+
+    Returns:
+        dict: Chunks processed, makespan, peak RSS and the per-call statistics
+    """
+    calls = []
+    _instrument_httpx(calls)
+
+    from document import PDF_Document
+    from summarizer import Summarizer, get_summary_prompt_path
+    from utils import load_summary_file
+
+    documents = [PDF_Document(file_path=path, config=config) for path in doc_paths]
+    summary_paths = [osp.join(doc.save_dir, f'summary_{summary_style}.json') for doc in documents]
+
+    start = time.perf_counter()
+    if pipeline == 'summarize':
+        summarizer = Summarizer(config)
+        for doc in documents:
+            summarizer._get_doc_summary(document=doc, summary_prompt_path=get_summary_prompt_path(config, summary_style),
+                                        save=True, summary_style=summary_style, incremental=False)
+        n_chunks = sum(len(doc.contents) for doc in documents)
+        n_failed = 0
+    elif pipeline == 'evaluate':
+        from evaluate import eval_multiple_summaries
+        eval_multiple_summaries(summary_paths, max_concurrency=max_concurrency, cache_dir=None, resume=False)
+        # test cases that failed are kept in the results as {'error': ...} and do not count as throughput
+        n_chunks, n_failed = 0, 0
+        for summary_path in summary_paths:
+            with open(osp.join(osp.dirname(summary_path), f'eval_results_{summary_style}.json'), 'r') as f:
+                eval_results = json.load(f)
+            n_failed += sum(1 for e in eval_results.values() if 'error' in e)
+            n_chunks += sum(1 for e in eval_results.values() if 'error' not in e)
+    else:
+        from text_to_speech import TextToSpeech
+        summarizer, text_to_speech = Summarizer(config), TextToSpeech(config)
+        n_chunks, n_failed = 0, 0
+        for summary_path in summary_paths:
+            summary = load_summary_file(summary_path)
+            text_to_speech.generate_speech(text=summarizer._format_chunks(summary), output_dir=osp.dirname(summary_path),
+                                           save=True, use_cache=False)
+            n_chunks += len(summary)
+    makespan = time.perf_counter() - start
+
+    return {
+        'chunks': n_chunks,
+        'failed_chunks': n_failed,
+        'makespan_s': makespan,
+        'chunks_per_s': n_chunks / makespan if makespan > 0 else None,
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'calls': get_call_stats(calls),
+        'latency': get_latency_stats([e[2] for e in calls if e[1] == 200]),
+        'failed_calls': sum(1 for e in calls if e[1] != 200),
+    }
+
+
+def _request_server(base_url, path):
+    with urllib.request.urlopen(base_url.rsplit('/v1', 1)[0] + path, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout.strip() != ''
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def compare(previous, current):
+    """Print the change of the main metrics against an earlier result file"""
+    print(f"\nCompared to {previous['commit']['commit']} ({previous['created_at']}):")
+    for pipeline, result in current['pipelines'].items():
+        before = previous['pipelines'].get(pipeline)
+        if before is None:
+            continue
+        for key, get in [('chunks/s', lambda e: e['chunks_per_s']),
+                         ('makespan s', lambda e: e['makespan_s']),
+                         ('p95 ms', lambda e: (e['latency'] or {}).get('p95_ms')),
+                         ('peak RSS MB', lambda e: e['peak_rss_mb']),
+                         ('failed chunks', lambda e: e.get('failed_chunks'))]:
+            old, new = get(before), get(result)
+            if old and new is not None:
+                print(f'  {pipeline:<10} {key:<13} {old:>10.2f} -> {new:>10.2f} ({(new - old) / old:+.1%})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against a fake OpenAI server")
+    parser.add_argument('--pipelines', type=str, nargs='+', default=PIPELINES, choices=PIPELINES, help='pipelines to run')
+    parser.add_argument('--books', type=int, default=2, help='number of synthetic books')
+    parser.add_argument('--chapters', type=int, default=10, help='chapters per book')
+    parser.add_argument('--words_per_chapter', type=int, default=1500, help='words per chapter')
+    parser.add_argument('--style', type=str, default='analytic', help='summary style')
+    parser.add_argument('--max_concurrency', type=int, default=20, help='test cases measured at once by the evaluation')
+    parser.add_argument('--latency', type=str, default='lognormal', choices=['constant', 'uniform', 'lognormal'],
+                        help='latency distribution of the fake server')
+    parser.add_argument('--latency_ms', type=float, default=300, help='median latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='sigma of the lognormal latency, or relative half-width of the uniform one')
+    parser.add_argument('--ms_per_token', type=float, default=0.0, help='extra latency per completion token')
+    parser.add_argument('--rate_429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help='share of requests answered with 500 or 503')
+    parser.add_argument('--port', type=int, default=8765, help='port of the fake server')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the books and the server')
+    parser.add_argument('--output_dir', type=str, default=None, help='directory of the result files')
+    parser.add_argument('--compare', type=str, default=None, help='earlier result file to compare with')
+
+    args = parser.parse_args()
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    settings = {'latency': args.latency, 'latency_ms': args.latency_ms, 'jitter': args.jitter,
+                'ms_per_token': args.ms_per_token, 'rate_429': args.rate_429, 'rate_5xx': args.rate_5xx,
+                'seed': args.seed}
+    base_url = f'http://127.0.0.1:{args.port}/v1'
+
+    # children are spawned, so that each one starts from an empty process
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=run_server, args=(settings, '127.0.0.1', args.port, ready), daemon=True)
+    server.start()
+    assert ready.wait(30), 'Fake server did not start'
+
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ['OPENAI_API_KEY'] = 'benchmark'
+    os.environ['DEEPEVAL_TELEMETRY_OPT_OUT'] = 'YES'
+
+    result = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'server': settings,
+        'workload': {'books': args.books, 'chapters': args.chapters, 'words_per_chapter': args.words_per_chapter,
+                     'style': args.style, 'max_concurrency': args.max_concurrency},
+        'pipelines': {},
+    }
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark_') as work_dir:
+            book_dir = mkdir_if_not_exists(osp.join(work_dir, 'books', 'Synthetic'))
+            doc_paths = []
+            for i in range(args.books):
+                doc_paths.append(osp.join(book_dir, f'Synthetic Book {i + 1}.pdf'))
+                make_synthetic_book(doc_paths[-1], args.chapters, args.words_per_chapter, seed=args.seed + i)
+
+            run_config = dict(config, OUTPUT_DIR=osp.join(work_dir, 'outputs'),
+                              TTS=dict(config['TTS'], CACHE_DIR=osp.join(work_dir, 'tts_cache')))
+
+            # evaluation and speech read the summaries, which are generated first in any case
+            pipelines = [e for e in PIPELINES if e in args.pipelines]
+            if pipelines[0] != 'summarize':
+                pipelines = ['summarize'] + pipelines
+
+            for pipeline in pipelines:
+                _request_server(base_url, '/reset')
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    pipeline_result = executor.submit(run_pipeline, pipeline, run_config, doc_paths, args.style,
+                                                      args.max_concurrency).result()
+                pipeline_result['server'] = _request_server(base_url, '/stats')
+
+                if pipeline in args.pipelines:
+                    result['pipelines'][pipeline] = pipeline_result
+                    latency = pipeline_result['latency'] or {}
+                    print(f"{pipeline}: {pipeline_result['chunks']} chunks in {pipeline_result['makespan_s']:.1f}s "
+                          f"({pipeline_result['chunks_per_s']:.2f} chunks/s, {pipeline_result['failed_chunks']} failed), "
+                          f"p50/p95/p99 {latency.get('p50_ms', 0):.0f}/{latency.get('p95_ms', 0):.0f}/"
+                          f"{latency.get('p99_ms', 0):.0f} ms, {pipeline_result['failed_calls']} failed calls, "
+                          f"peak RSS {pipeline_result['peak_rss_mb']:.0f} MB")
+    finally:
+        server.terminate()
+        server.join()
+
+    output_dir = mkdir_if_not_exists(args.output_dir or config['BENCHMARK_DIR'])
+    commit = (result['commit']['commit'] or 'nocommit')[:8]
+    output_path = osp.join(output_dir, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit}.json")
+    with open(output_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Saved results to {output_path}')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
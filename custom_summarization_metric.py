@@ -1,6 +1,12 @@
 import json
+import os
+import os.path as osp
 from typing import List, Optional, Union
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import deepeval
 
 from deepeval.test_case import (
     LLMTestCase,
@@ -24,6 +30,12 @@ from deepeval.metrics.faithfulness.schema import *
 
 from pydantic import BaseModel, Field
 
+from judge_models import get_judge_model
+from utils import count_tokens, get_text_hash, mkdir_if_not_exists, split_by_tokens
+
+# bump when the prompts of the source-side artifacts change to invalidate the source cache
+SOURCE_CACHE_VERSION = "1"
+
 required_params: List[LLMTestCaseParams] = [
     LLMTestCaseParams.INPUT,
     LLMTestCaseParams.ACTUAL_OUTPUT,
@@ -49,6 +61,19 @@ class ComplexQuestionVerdict(ComplexQuestionVerdictOutput):
 class ComplexQuestionsVerdictsOutputs(BaseModel):
     verdicts: List[ComplexQuestionVerdictOutput]
 
+class JointAnswer(BaseModel):
+    original_answer: str
+    summary_answer: str
+
+class JointAnswers(BaseModel):
+    answers: List[JointAnswer]
+
+class ComplexAnswerVerdictOutput(ComplexQuestionVerdictOutput):
+    summary_answer: str
+
+class ComplexAnswersVerdictsOutputs(BaseModel):
+    verdicts: List[ComplexAnswerVerdictOutput]
+
 
 
 
@@ -65,9 +90,14 @@ class CustomSummarizationMetric(BaseMetric):
         strict_mode: bool = False,
         verbose_mode: bool = False,
         truths_extraction_limit: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        merged_answers: bool = False,
+        max_answer_retries: int = 2,
+        truths_window_tokens: Optional[int] = None,
     ):
         self.threshold = 1 if strict_mode else threshold
-        self.model, self.using_native_model = initialize_model(model)
+        # judge models are shared process-wide, so all metrics reuse one connection pool
+        self.model, self.using_native_model = initialize_model(get_judge_model(model))
         self.evaluation_model = self.model.get_model_name()
 
         if assessment_questions is not None and len(assessment_questions) == 0:
@@ -87,6 +117,25 @@ class CustomSummarizationMetric(BaseMetric):
         if self.truths_extraction_limit is not None:
             self.truths_extraction_limit = max(self.truths_extraction_limit, 0)
 
+        # source texts longer than this are split into windows and truths are extracted
+        # from each window concurrently, otherwise the whole text is used as the truths
+        self.truths_window_tokens = truths_window_tokens
+
+        # artifacts that only depend on the source text (truths, questions and
+        # source answers) are shared through this cache across summaries of it
+        self.cache_dir = cache_dir
+        self.provided_assessment_questions = self.assessment_questions
+        self.cached_truths = None
+        self.original_answers = None
+
+        # answer the questions on both texts in one request, and answer and score
+        # the complex questions in one request
+        self.merged_answers = merged_answers
+        self.max_answer_retries = max_answer_retries
+
+        # the sync measure runs independent stages in threads, which all add to the cost
+        self._cost_lock = threading.Lock()
+
     def measure(
         self,
         test_case: Union[LLMTestCase, ConversationalTestCase],
@@ -104,19 +153,28 @@ class CustomSummarizationMetric(BaseMetric):
                     self.a_measure(test_case, _show_indicator=False)
                 )
             else:
-                self.truths: str = self._generate_truths(test_case.input)
-                self.claims: List[str] = self._generate_claims(
-                    test_case.actual_output
-                )
-                self.coverage_verdicts: List[SummarizationCoverageVerdict] = (
-                    self._generate_coverage_verdicts(test_case)
-                )
-                self.alignment_verdicts: List[SummarizationAlignmentVerdict] = (
-                    self._generate_alignment_verdicts()
-                )
-                self.complex_coverage_verdicts: List[ComplexQuestionVerdict] = (
-                    self._generate_complex_coverage_verdicts(test_case)
-                )
+                self._load_source_cache(test_case.input)
+                # coverage and complex coverage only need the texts, alignment needs
+                # the truths and claims, so run the stages in threads as they get ready
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    truths = executor.submit(self._get_truths, test_case.input)
+                    claims = executor.submit(self._generate_claims, test_case.actual_output)
+                    coverage_verdicts = executor.submit(self._generate_coverage_verdicts, test_case)
+                    complex_coverage_verdicts = executor.submit(self._generate_complex_coverage_verdicts, test_case)
+
+                    self.truths: str = truths.result()
+                    self.claims: List[str] = claims.result()
+                    alignment_verdicts = executor.submit(self._generate_alignment_verdicts)
+
+                    self.coverage_verdicts: List[SummarizationCoverageVerdict] = (
+                        coverage_verdicts.result()
+                    )
+                    self.alignment_verdicts: List[SummarizationAlignmentVerdict] = (
+                        alignment_verdicts.result()
+                    )
+                    self.complex_coverage_verdicts: List[ComplexQuestionVerdict] = (
+                        complex_coverage_verdicts.result()
+                    )
 
                 alignment_score = self._calculate_score(ScoreType.ALIGNMENT)
                 coverage_score = self._calculate_score(ScoreType.COVERAGE)
@@ -147,6 +205,7 @@ class CustomSummarizationMetric(BaseMetric):
                     'success': self.success,
                 }
                 self.verbose_logs = json.dumps(logs)
+                self._save_source_cache(test_case.input)
 
                 return self.score
 
@@ -165,8 +224,9 @@ class CustomSummarizationMetric(BaseMetric):
             async_mode=True,
             _show_indicator=_show_indicator,
         ):
+            self._load_source_cache(test_case.input)
             self.truths, self.claims = await asyncio.gather(
-                self._a_generate_truths(test_case.input),
+                self._a_get_truths(test_case.input),
                 self._a_generate_claims(test_case.actual_output),
             )
 
@@ -212,8 +272,153 @@ class CustomSummarizationMetric(BaseMetric):
                 'success': self.success,
             }
             self.verbose_logs = json.dumps(logs)
+            self._save_source_cache(test_case.input)
             return self.score
 
+    def _get_source_cache_path(self, text: str) -> str:
+        key = {
+            'text': get_text_hash(text),
+            'n': self.n,
+            'n_complex_questions': self.n_complex_questions,
+            'truths_extraction_limit': self.truths_extraction_limit,
+            'truths_window_tokens': self.truths_window_tokens,
+            'assessment_questions': self.provided_assessment_questions,
+            'model': self.evaluation_model,
+            'version': SOURCE_CACHE_VERSION,
+            'deepeval_version': deepeval.__version__,
+        }
+        return osp.join(self.cache_dir, get_text_hash(json.dumps(key, sort_keys=True)) + '.json')
+
+    def _load_source_cache(self, text: str):
+        self.cached_truths = None
+        self.original_answers = None
+        self.source_cache_hit = False
+
+        if self.cache_dir is None:
+            return
+
+        # never carry artifacts of a previous source text over to this one
+        self.assessment_questions = self.provided_assessment_questions
+        self.complex_assessment_questions = None
+
+        path = self._get_source_cache_path(text)
+        if not osp.exists(path):
+            return
+
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        self.cached_truths = data['truths']
+        self.assessment_questions = data['assessment_questions']
+        self.complex_assessment_questions = [ComplexQuestion(**e) for e in data['complex_assessment_questions']]
+        self.original_answers = data['original_answers']
+        self.source_cache_hit = True
+
+    def _save_source_cache(self, text: str):
+        if self.cache_dir is None or self.source_cache_hit:
+            return
+
+        data = {
+            'truths': self.truths,
+            'assessment_questions': self.assessment_questions,
+            'complex_assessment_questions': [e.dict() for e in self.complex_assessment_questions],
+            'original_answers': self.original_answers,
+        }
+
+        mkdir_if_not_exists(self.cache_dir)
+        path = self._get_source_cache_path(text)
+        # write then rename, so concurrent evaluations never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _add_cost(self, cost: float):
+        with self._cost_lock:
+            self.evaluation_cost += cost
+
+    async def _a_get_truths(self, text: str) -> str:
+        if self.cached_truths is not None:
+            return self.cached_truths
+        return await self._a_generate_truths(text)
+
+    def _get_truths(self, text: str) -> str:
+        if self.cached_truths is not None:
+            return self.cached_truths
+        return self._generate_truths(text)
+
+    async def _a_get_original_answers(self, text: str) -> List[str]:
+        if self.original_answers is None:
+            self.original_answers = await self._a_generate_answers(text)
+        return self.original_answers
+
+    def _get_original_answers(self, text: str) -> List[str]:
+        if self.original_answers is None:
+            self.original_answers = self._generate_answers(text)
+        return self.original_answers
+
+    async def _a_generate_data(self, prompt: str, schema) -> dict:
+        if self.using_native_model:
+            res, cost = await self.model.a_generate(prompt)
+            self._add_cost(cost)
+            return trimAndLoadJson(res, self)
+        else:
+            try:
+                res = await self.model.a_generate(prompt, schema=schema)
+                return res.dict()
+            except TypeError:
+                res = await self.model.a_generate(prompt)
+                return trimAndLoadJson(res, self)
+
+    def _generate_data(self, prompt: str, schema) -> dict:
+        if self.using_native_model:
+            res, cost = self.model.generate(prompt)
+            self._add_cost(cost)
+            return trimAndLoadJson(res, self)
+        else:
+            try:
+                res = self.model.generate(prompt, schema=schema)
+                return res.dict()
+            except TypeError:
+                res = self.model.generate(prompt)
+                return trimAndLoadJson(res, self)
+
+    async def _a_generate_answers_with_retry(self, questions: list, make_prompt, schema, key: str, default) -> list:
+        answers = [None] * len(questions)
+        pending = list(range(len(questions)))
+        for _ in range(self.max_answer_retries + 1):
+            data = await self._a_generate_data(make_prompt([questions[i] for i in pending]), schema)
+            # answers follow the order of the asked questions, extra answers are dropped
+            # and only the unanswered questions are asked again
+            for i, answer in zip(pending, data[key]):
+                answers[i] = answer
+            pending = pending[len(data[key]):]
+            if len(pending) == 0:
+                return answers
+
+        print(f'No answer generated for {len(pending)} questions, using {default}')
+        for i in pending:
+            answers[i] = default
+        return answers
+
+    def _generate_answers_with_retry(self, questions: list, make_prompt, schema, key: str, default) -> list:
+        answers = [None] * len(questions)
+        pending = list(range(len(questions)))
+        for _ in range(self.max_answer_retries + 1):
+            data = self._generate_data(make_prompt([questions[i] for i in pending]), schema)
+            # answers follow the order of the asked questions, extra answers are dropped
+            # and only the unanswered questions are asked again
+            for i, answer in zip(pending, data[key]):
+                answers[i] = answer
+            pending = pending[len(data[key]):]
+            if len(pending) == 0:
+                return answers
+
+        print(f'No answer generated for {len(pending)} questions, using {default}')
+        for i in pending:
+            answers[i] = default
+        return answers
+
     async def _a_generate_reason(self) -> str:
         if self.include_reason is False:
             return None
@@ -252,7 +457,7 @@ class CustomSummarizationMetric(BaseMetric):
 
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["reason"]
         else:
@@ -302,7 +507,7 @@ class CustomSummarizationMetric(BaseMetric):
 
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["reason"]
         else:
@@ -352,7 +557,7 @@ class CustomSummarizationMetric(BaseMetric):
         )
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["answers"]
         else:
@@ -372,7 +577,7 @@ class CustomSummarizationMetric(BaseMetric):
         )
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["answers"]
         else:
@@ -388,7 +593,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_answers(self.complex_assessment_questions, text)
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["answers"]
         else:
@@ -404,7 +609,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_answers(self.complex_assessment_questions, text)
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["answers"]
         else:
@@ -420,7 +625,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = SummarizationTemplate.generate_questions(text=text, n=self.n)
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["questions"]
         else:
@@ -438,7 +643,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = SummarizationTemplate.generate_questions(text=text, n=self.n)
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["questions"]
         else:
@@ -454,7 +659,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_questions(text, self.n_complex_questions)
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             data = [ComplexQuestion(**e) for e in data["questions"]]
             return data
@@ -474,7 +679,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_questions(text, self.n_complex_questions)
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             data = [ComplexQuestion(**e) for e in data["questions"]]
             return data
@@ -494,6 +699,82 @@ class CustomSummarizationMetric(BaseMetric):
 
 
 
+    async def _a_generate_merged_coverage_verdicts(
+        self, test_case: LLMTestCase
+    ) -> List[SummarizationCoverageVerdict]:
+        if self.original_answers is not None:
+            # source answers are cached, only the summary needs answering
+            summary_answers = await self._a_generate_answers_with_retry(
+                self.assessment_questions,
+                lambda questions: SummarizationTemplate.generate_answers(questions=questions, text=test_case.actual_output),
+                Answers, 'answers', 'idk')
+        else:
+            answers = await self._a_generate_answers_with_retry(
+                self.assessment_questions,
+                lambda questions: generate_joint_answers(questions, test_case.input, test_case.actual_output),
+                JointAnswers, 'answers', {'original_answer': 'idk', 'summary_answer': 'idk'})
+            self.original_answers = [e['original_answer'] for e in answers]
+            summary_answers = [e['summary_answer'] for e in answers]
+
+        return [
+            SummarizationCoverageVerdict(
+                summary_verdict=summary_answers[i],
+                original_verdict=self.original_answers[i],
+                question=self.assessment_questions[i],
+            )
+            for i in range(len(self.assessment_questions))
+        ]
+
+    def _generate_merged_coverage_verdicts(
+        self, test_case: LLMTestCase
+    ) -> List[SummarizationCoverageVerdict]:
+        if self.original_answers is not None:
+            # source answers are cached, only the summary needs answering
+            summary_answers = self._generate_answers_with_retry(
+                self.assessment_questions,
+                lambda questions: SummarizationTemplate.generate_answers(questions=questions, text=test_case.actual_output),
+                Answers, 'answers', 'idk')
+        else:
+            answers = self._generate_answers_with_retry(
+                self.assessment_questions,
+                lambda questions: generate_joint_answers(questions, test_case.input, test_case.actual_output),
+                JointAnswers, 'answers', {'original_answer': 'idk', 'summary_answer': 'idk'})
+            self.original_answers = [e['original_answer'] for e in answers]
+            summary_answers = [e['summary_answer'] for e in answers]
+
+        return [
+            SummarizationCoverageVerdict(
+                summary_verdict=summary_answers[i],
+                original_verdict=self.original_answers[i],
+                question=self.assessment_questions[i],
+            )
+            for i in range(len(self.assessment_questions))
+        ]
+
+    async def _a_generate_merged_complex_coverage_verdicts(self, test_case: LLMTestCase) -> List[ComplexQuestionVerdict]:
+        verdicts = await self._a_generate_answers_with_retry(
+            self.complex_assessment_questions,
+            lambda questions: generate_complex_answers_and_verdicts(questions, test_case.actual_output),
+            ComplexAnswersVerdictsOutputs, 'verdicts',
+            {'summary_answer': 'idk', 'score': 0, 'reason': 'No answer was generated.'})
+
+        # only the validated fields of the model output, it may echo the question or add keys
+        return [ComplexQuestionVerdict(original_answer=q.answer, question=q.question,
+                                       **ComplexAnswerVerdictOutput(**v).dict())
+                for q, v in zip(self.complex_assessment_questions, verdicts)]
+
+    def _generate_merged_complex_coverage_verdicts(self, test_case: LLMTestCase) -> List[ComplexQuestionVerdict]:
+        verdicts = self._generate_answers_with_retry(
+            self.complex_assessment_questions,
+            lambda questions: generate_complex_answers_and_verdicts(questions, test_case.actual_output),
+            ComplexAnswersVerdictsOutputs, 'verdicts',
+            {'summary_answer': 'idk', 'score': 0, 'reason': 'No answer was generated.'})
+
+        # only the validated fields of the model output, it may echo the question or add keys
+        return [ComplexQuestionVerdict(original_answer=q.answer, question=q.question,
+                                       **ComplexAnswerVerdictOutput(**v).dict())
+                for q, v in zip(self.complex_assessment_questions, verdicts)]
+
     async def _a_generate_coverage_verdicts(
         self, test_case: LLMTestCase
     ) -> List[SummarizationCoverageVerdict]:
@@ -502,8 +783,11 @@ class CustomSummarizationMetric(BaseMetric):
                 await self._a_generate_assessment_questions(test_case.input)
             )
 
+        if self.merged_answers:
+            return await self._a_generate_merged_coverage_verdicts(test_case)
+
         tasks = [
-            self._a_generate_answers(test_case.input),
+            self._a_get_original_answers(test_case.input),
             self._a_generate_answers(test_case.actual_output),
         ]
         results = await asyncio.gather(*tasks)
@@ -532,8 +816,14 @@ class CustomSummarizationMetric(BaseMetric):
                 test_case.input
             )
 
-        original_answers = self._generate_answers(test_case.input)
-        summary_answers = self._generate_answers(test_case.actual_output)
+        if self.merged_answers:
+            return self._generate_merged_coverage_verdicts(test_case)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            original_answers = executor.submit(self._get_original_answers, test_case.input)
+            summary_answers = executor.submit(self._generate_answers, test_case.actual_output)
+            original_answers = original_answers.result()
+            summary_answers = summary_answers.result()
 
         if len(original_answers) != len(summary_answers):
             raise ValueError("Number of verdicts generated does not equal.")
@@ -557,6 +847,9 @@ class CustomSummarizationMetric(BaseMetric):
         
         print(f'Generated complex assessment questions = {self.complex_assessment_questions}')
 
+        if self.merged_answers:
+            return self._generate_merged_complex_coverage_verdicts(test_case)
+
         original_answers = [e.answer for e in self.complex_assessment_questions]
         summary_answers: List[str] = self._generate_complex_answers(test_case.actual_output)
 
@@ -570,7 +863,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_verdicts(answers)
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             out = [ComplexQuestionVerdict(original_answer=answers[i]['original_answer'], summary_answer=answers[i]['summary_answer'],
                                               question = self.complex_assessment_questions[i].question,
@@ -600,6 +893,9 @@ class CustomSummarizationMetric(BaseMetric):
         
         print(f'Generated complex assessment questions = {self.complex_assessment_questions}')
 
+        if self.merged_answers:
+            return await self._a_generate_merged_complex_coverage_verdicts(test_case)
+
         original_answers = [e.answer for e in self.complex_assessment_questions]
         summary_answers: List[str] = await self._a_generate_complex_answers(test_case.actual_output)
 
@@ -613,7 +909,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = generate_complex_verdicts(answers)
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             out = [ComplexQuestionVerdict(original_answer=answers[i]['original_answer'], summary_answer=answers[i]['summary_answer'],
                                               question = self.complex_assessment_questions[i].question,
@@ -649,7 +945,7 @@ class CustomSummarizationMetric(BaseMetric):
         )
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             verdicts = [
                 SummarizationAlignmentVerdict(**item)
@@ -684,7 +980,7 @@ class CustomSummarizationMetric(BaseMetric):
         )
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             verdicts = [
                 SummarizationAlignmentVerdict(**item)
@@ -705,17 +1001,47 @@ class CustomSummarizationMetric(BaseMetric):
                 ]
                 return verdicts
 
+    def _get_truth_windows(self, text: str) -> List[str]:
+        if self.truths_window_tokens is None or count_tokens(text) <= self.truths_window_tokens:
+            return [text]
+        return split_by_tokens(text, self.truths_window_tokens)
+
+    def _merge_truths(self, truths: List[List[str]]) -> str:
+        # windows can repeat the same fact, keep the first occurrence of each truth
+        merged = {}
+        for window_truths in truths:
+            for truth in window_truths:
+                merged.setdefault(' '.join(truth.lower().split()), truth)
+        return '\n'.join(merged.values())
+
     async def _a_generate_truths(self, text: str) -> str:
-        return text
+        windows = self._get_truth_windows(text)
+        if len(windows) == 1:
+            return text
+
+        results = await asyncio.gather(*[
+            self._a_generate_data(FaithfulnessTemplate.generate_truths(window, self.truths_extraction_limit), Truths)
+            for window in windows
+        ])
+        return self._merge_truths([e['truths'] for e in results])
+
     def _generate_truths(self, text: str) -> str:
-        return text
+        windows = self._get_truth_windows(text)
+        if len(windows) == 1:
+            return text
+
+        with ThreadPoolExecutor(max_workers=min(len(windows), 8)) as executor:
+            results = list(executor.map(
+                lambda window: self._generate_data(FaithfulnessTemplate.generate_truths(window, self.truths_extraction_limit), Truths),
+                windows))
+        return self._merge_truths([e['truths'] for e in results])
     
     async def _a_generate_claims(self, text: str) -> List[str]:
         # Borrow faithfulness template
         prompt = FaithfulnessTemplate.generate_claims(actual_output=text)
         if self.using_native_model:
             res, cost = await self.model.a_generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["claims"]
         else:
@@ -733,7 +1059,7 @@ class CustomSummarizationMetric(BaseMetric):
         prompt = FaithfulnessTemplate.generate_claims(actual_output=text)
         if self.using_native_model:
             res, cost = self.model.generate(prompt)
-            self.evaluation_cost += cost
+            self._add_cost(cost)
             data = trimAndLoadJson(res, self)
             return data["claims"]
         else:
@@ -820,4 +1146,47 @@ Text:
 {text}
 
 JSON:
-"""
\ No newline at end of file
+"""
+
+def generate_joint_answers(questions, original_text, summary):
+    return f"""Based on the list of close-ended 'yes' or 'no' questions, determine for EACH question whether the original text and whether the summary contain sufficient information to answer it.
+Generate a JSON with key 'answers', which is a list of JSON objects with the keys 'original_answer' and 'summary_answer'.
+'original_answer' is 'yes' if the original text contains sufficient information to answer the question, otherwise 'no'.
+'summary_answer' is 'yes' if the summary contains sufficient information to answer the question, otherwise 'no'.
+Judge each text on its own, do not use information from the other text.
+
+The length of 'answers' SHOULD BE STRICTLY EQUAL to that of questions, in the same order as the questions.
+
+Original Text:
+{original_text}
+
+Summary:
+{summary}
+
+Questions:
+{questions}
+
+JSON:
+"""
+
+def generate_complex_answers_and_verdicts(questions, summary):
+    questions = [{'question': q.question, 'original_answer': q.answer} for q in questions]
+    return f"""You are given a summary and a list of JSON objects. Each contains a 'question' and its correct 'original_answer'.
+    For each question, first answer it using ONLY information from the summary, as a concise 1-sentence long answer which does not need to be in full sentences.
+    If the summary does not contain enough information to answer the question, the answer is 'idk'.
+    Then assess if your summary answer is correct, based on the model answer which is the original answer.
+    Give a score from 0 to 5, with 0 being completely wrong, and 5 being completely correct.
+    If the summary answer is 'idk', return a score of 0.
+
+    Return a JSON object with the key 'verdicts', which is a list of JSON objects, with the keys: 'summary_answer', 'score', and 'reason': a concise 1 sentence explanation for the score.
+
+The length of the list SHOULD BE STRICTLY EQUAL to that of the questions list, in the same order as the questions.
+
+Summary:
+{summary}
+
+Questions:
+{questions}
+
+JSON:
+"""
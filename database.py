@@ -0,0 +1,186 @@
+import glob
+import json
+import os
+import os.path as osp
+import sqlite3
+import argparse
+from datetime import datetime
+from utils import get_text_hash, compress_text, decompress_text, get_text_blob_dir, load_summary_file, save_summary_file
+
+def get_db_connection(db_file):
+    """Open a connection that tolerates concurrent Streamlit sessions and workers"""
+    # wait for a lock instead of failing with "database is locked"
+    conn = sqlite3.connect(db_file, timeout=30)
+    # readers do not block the writer and the writer does not block readers
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    # texts are stored compressed, SQL reads them through this function
+    conn.create_function('decompress_text', 1, decompress_text, deterministic=True)
+    return conn
+
+def add_column_if_missing(c, table, column, column_type):
+    """Add a column to a table created by an earlier version"""
+    columns = [e[1] for e in c.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def init_blob_table(conn):
+    """Create the table of compressed texts, keyed by the hash of the text"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB,
+                size INTEGER
+            )
+        ''')
+
+def put_texts(conn, texts):
+    """
+    Store texts as compressed blobs, identical texts only once. Callers run it inside
+    the transaction that writes the rows referring to the blobs.
+
+    Returns:
+        list: Hash of each text
+    """
+    hashes = [get_text_hash(text) for text in texts]
+
+    # only compress the texts that are not stored yet
+    known = set()
+    for i in range(0, len(hashes), 500):
+        batch = hashes[i:i + 500]
+        known.update(e[0] for e in conn.execute(
+            f'SELECT hash FROM blobs WHERE hash IN ({",".join("?" * len(batch))})', batch))
+
+    new = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in known}
+    conn.executemany('''
+        INSERT INTO blobs (hash, data, size) VALUES (?, ?, ?) ON CONFLICT (hash) DO NOTHING
+    ''', [(text_hash, compress_text(text), len(text.encode('utf-8'))) for text_hash, text in new.items()])
+    return hashes
+
+def get_summary_version(config, prompt_file):
+    """Hashes of the prompt and the model routing a summary depends on"""
+    with open(osp.join(config["PROMPT_DIR"], prompt_file), 'r') as f:
+        prompt_hash = get_text_hash(f.read())
+    routing_hash = get_text_hash(json.dumps(config['ROUTING'], sort_keys=True))
+    return prompt_hash, routing_hash
+
+def insert_summary(conn, book_id, summary_style, content_hash, prompt_hash, routing_hash, summary_json):
+    """
+    Insert a summary event and its chunk summaries. The content hash is the one of the
+    edition of the book that was summarized. Callers run it inside a transaction.
+
+    Returns:
+        int: Id of the summary
+    """
+    # insert summary event
+    c = conn.execute('''
+        INSERT INTO summaries (book_id, summary_style, created_at, content_hash, prompt_hash, routing_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (book_id, summary_style, datetime.now(), content_hash, prompt_hash, routing_hash))
+
+    summary_id = c.lastrowid
+
+    # insert chunk summaries, a chunk summary identical to an earlier one reuses its blob
+    chunk_ids = list(summary_json.keys())
+    hashes = put_texts(conn, [summary_json[chunk_id]['summary'] for chunk_id in chunk_ids])
+    conn.executemany('''
+        INSERT INTO chunk_summaries (summary_id, chunk_order, summary_hash)
+        VALUES (?, ?, ?)
+    ''', [(summary_id, int(chunk_id), summary_hash) for chunk_id, summary_hash in zip(chunk_ids, hashes)])
+    return summary_id
+
+def _move_column_to_blobs(conn, table, column, hash_column):
+    rows = conn.execute(f'SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL').fetchall()
+    hashes = put_texts(conn, [text for _, text in rows])
+    conn.executemany(f'UPDATE {table} SET {hash_column} = ?, {column} = NULL WHERE id = ?',
+                     [(text_hash, row_id) for (row_id, _), text_hash in zip(rows, hashes)])
+    return len(rows), sum(len(text.encode('utf-8')) for _, text in rows)
+
+def migrate_to_blobs(conn):
+    """
+    Move the chunk texts and chunk summaries that earlier versions stored inline to blobs.
+
+    Returns:
+        dict: Rows moved, their text size, and the size of all blobs before and after compression
+    """
+    with conn:
+        n_chunks, chunk_bytes = _move_column_to_blobs(conn, 'chunks', 'chunk_text', 'text_hash')
+        n_summaries, summary_bytes = _move_column_to_blobs(conn, 'chunk_summaries', 'chunk_summary', 'summary_hash')
+
+    text_bytes, blob_bytes = conn.execute('''
+        SELECT COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM blobs
+    ''').fetchone()
+    return {
+        'chunks': n_chunks,
+        'chunk_summaries': n_summaries,
+        'inline_bytes': chunk_bytes + summary_bytes,
+        'text_bytes': text_bytes,
+        'blob_bytes': blob_bytes,
+    }
+
+def migrate_summary_files(output_dir):
+    """
+    Rewrite the summary_{style}.json files of the library that still hold their chunk
+    texts inline, so that each book keeps its chunk texts once, in its text blobs.
+
+    Returns:
+        dict: Files rewritten and their size, with the new blobs, before and after
+    """
+    report = {'files': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for summary_path in sorted(glob.glob(osp.join(output_dir, '*', '*', 'summary_*.json'))):
+        with open(summary_path, 'r') as f:
+            if not any('text' in chunk for chunk in json.load(f).values()):
+                continue
+
+        blob_dir = get_text_blob_dir(summary_path)
+        blobs_before = set(os.listdir(blob_dir)) if osp.exists(blob_dir) else set()
+        report['bytes_before'] += osp.getsize(summary_path)
+
+        save_summary_file(summary_path, load_summary_file(summary_path))
+
+        new_blobs = set(os.listdir(blob_dir)) - blobs_before
+        report['bytes_after'] += osp.getsize(summary_path) + sum(osp.getsize(osp.join(blob_dir, e)) for e in new_blobs)
+        report['files'] += 1
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="App database maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='move inline texts to compressed blobs and report the bytes saved')
+    migrate_parser.add_argument('--db_file', type=str, default='books.db', help='database of the app')
+    migrate_parser.add_argument('--output_dir', type=str, default=None, help='also migrate the summary files of this library')
+
+    args = parser.parse_args()
+
+    if osp.exists(args.db_file):
+        # imported here, search imports this module
+        from search import init_search_index, drop_outdated_search_index
+
+        size_before = osp.getsize(args.db_file)
+        conn = get_db_connection(args.db_file)
+        init_blob_table(conn)
+        add_column_if_missing(conn, 'chunks', 'text_hash', 'TEXT')
+        add_column_if_missing(conn, 'chunk_summaries', 'summary_hash', 'TEXT')
+        drop_outdated_search_index(conn)
+        report = migrate_to_blobs(conn)
+        init_search_index(conn)
+        # give the pages freed by the inline texts back to the file system
+        conn.execute('VACUUM')
+        conn.close()
+        size_after = osp.getsize(args.db_file)
+
+        print(f"Moved {report['chunks']} chunk texts and {report['chunk_summaries']} chunk summaries "
+              f"({report['inline_bytes'] / 1e6:.1f} MB) to blobs")
+        print(f"Blobs hold {report['text_bytes'] / 1e6:.1f} MB of distinct text in {report['blob_bytes'] / 1e6:.1f} MB")
+        print(f"{args.db_file}: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB, "
+              f"saved {(size_before - size_after) / 1e6:.1f} MB")
+
+    if args.output_dir is not None:
+        report = migrate_summary_files(args.output_dir)
+        print(f"{args.output_dir}: rewrote {report['files']} summary files, "
+              f"{report['bytes_before'] / 1e6:.1f} MB -> {report['bytes_after'] / 1e6:.1f} MB, "
+              f"saved {(report['bytes_before'] - report['bytes_after']) / 1e6:.1f} MB")
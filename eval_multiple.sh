@@ -5,6 +5,8 @@
 # python evaluate.py --summary_path outputs/Self-Development/Atomic\ Habits/summary_analytic.json --style analytic
 # python evaluate.py --summary_path outputs/Self-Development/Atomic\ Habits/summary_bullet_points.json --style bullet_points
 
-python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_analytic.json --style analytic
-python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_bullet_points.json --style bullet_points
-python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_narrative.json --style narrative
\ No newline at end of file
+# python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_analytic.json --style analytic
+# python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_bullet_points.json --style bullet_points
+# python evaluate.py --summary_path outputs/Self-Development/Deep\ Work/summary_narrative.json --style narrative
+
+python evaluate.py --summary_paths "outputs/Self-Development/Deep Work/summary_*.json" --max_concurrency 20
\ No newline at end of file
@@ -1,9 +1,16 @@
 from custom_summarization_metric import CustomSummarizationMetric
 from deepeval.test_case import LLMTestCase
-from deepeval import evaluate
+import asyncio
+import glob
 import json
+import numpy as np
+import os
 import os.path as osp
-from utils import mkdir_if_not_exists
+import re
+import time
+from utils import mkdir_if_not_exists, get_text_hash, load_summary_file
+from local_metrics import prescreen
+from judge_models import run_with_judge_models
 import argparse
 
 def get_summary_dict(md_path: str) -> dict:
@@ -65,50 +72,511 @@ def get_full_content_dict(json_data):
         process_item(item)
     return sections
 
-def eval_summaries(summary_path, summary_style, save_result=True):
-    with open(summary_path, 'r') as f:
-        summary_dict = json.load(f)
+def prescreen_chunks(chunks, prescreen_config):
+    """
+    Score chunks with the local metrics in one vectorized batch.
+
+    Args:
+        chunks (dict): Key to a chunk with 'text' and 'summary'
+        prescreen_config (dict): The LOCAL_METRICS config
+
+    Returns:
+        dict: Key to the prescreen result, whose 'tier' tells if the LLM judge is still needed
+    """
+    keys = list(chunks.keys())
+    results = prescreen([chunks[k]['text'] for k in keys],
+                        [chunks[k]['summary'] for k in keys],
+                        prescreen_config)
+    return dict(zip(keys, results))
+
+def get_local_result(screen_result, prescreen_config):
+    # the local score is on another scale than the judge score, it is kept apart in local_score
+    return dict(screen_result, success=screen_result['local_score'] > prescreen_config['HIGH'])
+
+def get_checkpoint_path(summary_path, summary_style):
+    return osp.join(osp.dirname(summary_path), f'eval_checkpoint_{summary_style}.jsonl')
+
+def get_checkpoint_entry(chunk_id, chunk, result):
+    return {
+        'chunk_id': chunk_id,
+        'text_hash': get_text_hash(chunk['text']),
+        'summary_hash': get_text_hash(chunk['summary']),
+        'result': result,
+    }
+
+def load_checkpoint(checkpoint_path, summary_dict):
+    """
+    Load the results of chunks scored by a previous run whose text and summary did not change.
+
+    Returns:
+        dict: Chunk id to its evaluation result
+    """
+    if not osp.exists(checkpoint_path):
+        return {}
+
+    entries = {}
+    with open(checkpoint_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+            entries[entry['chunk_id']] = entry
+
+    result_dict = {}
+    for chunk_id, chunk in summary_dict.items():
+        entry = entries.get(chunk_id)
+        if entry is not None and entry == get_checkpoint_entry(chunk_id, chunk, entry['result']):
+            result_dict[chunk_id] = entry['result']
+    return result_dict
+
+def append_checkpoint(checkpoint_path, chunk_id, chunk, result):
+    with open(checkpoint_path, 'a') as f:
+        f.write(json.dumps(get_checkpoint_entry(chunk_id, chunk, result)) + '\n')
+
+def save_checkpoint(checkpoint_path, summary_dict, result_dict):
+    """
+    Rewrite the checkpoint with the LLM results of the current chunks only.
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for chunk_id, result in result_dict.items():
+            if 'error' in result or result.get('tier') == 'local':
+                continue
+            f.write(json.dumps(get_checkpoint_entry(chunk_id, summary_dict[chunk_id], result)) + '\n')
+    os.replace(tmp_path, checkpoint_path)
+
+async def a_measure_test_case(test_case, semaphore, source_locks, cache_dir=None, merged_answers=False,
+                              truths_window_tokens=None):
+    """
+    Measure one test case while holding the semaphore. With a cache_dir, test cases of the
+    same source text wait on its lock in source_locks until the first one has filled the
+    source cache, so the truths of a source are only extracted once.
+
+    Returns:
+        dict: The verbose logs of the metric, or the error
+    """
+    metric = CustomSummarizationMetric(n_complex_questions = 3, 
+                                       verbose_mode=False,
+                                       cache_dir=cache_dir,
+                                       merged_answers=merged_answers,
+                                       truths_window_tokens=truths_window_tokens)
+    try:
+        measured = False
+        if cache_dir is not None:
+            lock = source_locks.setdefault(get_text_hash(test_case.input), asyncio.Lock())
+            async with lock:
+                if not osp.exists(metric._get_source_cache_path(test_case.input)):
+                    async with semaphore:
+                        await metric.a_measure(test_case, _show_indicator=False)
+                    measured = True
+        if not measured:
+            async with semaphore:
+                await metric.a_measure(test_case, _show_indicator=False)
+        return json.loads(metric.verbose_logs)
+    except Exception as e:
+        print(f'\nFailed to evaluate test case: {e}')
+        return {'error': str(e)}
+
+def eval_summaries(summary_path, summary_style, save_result=True, cache_dir=None, merged_answers=False,
+                   prescreen_config=None, truths_window_tokens=None, max_concurrency=20, resume=True):
+    """
+    Evaluate every chunk of a summary file. Each LLM result is appended to
+    eval_checkpoint_{style}.jsonl as soon as its test case finishes, so a re-run only
+    scores the chunks that are missing or whose text or summary changed.
+    """
+    summary_dict = load_summary_file(summary_path)
 
     summary_dict = {k: v for k, v in summary_dict.items() if v['text'] != ''}
 
-    test_cases = []
+    checkpoint_path = get_checkpoint_path(summary_path, summary_style)
+    result_dict = load_checkpoint(checkpoint_path, summary_dict) if resume else {}
+    if len(result_dict) > 0:
+        print(f'{len(result_dict)} chunks restored from {checkpoint_path}')
+    pending_dict = {k: v for k, v in summary_dict.items() if k not in result_dict}
+
+    # settle the clear-cut chunks locally and only send the uncertain ones to the LLM judge
+    screen_results = {}
+    if prescreen_config is not None:
+        screen_results = prescreen_chunks(pending_dict, prescreen_config)
+        for chunk_id, screen_result in screen_results.items():
+            if screen_result['tier'] == 'local':
+                result_dict[chunk_id] = get_local_result(screen_result, prescreen_config)
+        pending_dict = {k: v for k, v in pending_dict.items() if k not in result_dict}
+        print(f'{len(screen_results) - len(pending_dict)} chunks scored locally, '
+              f'{len(pending_dict)} chunks sent to the LLM judge')
+
+    if save_result:
+        mkdir_if_not_exists(osp.dirname(summary_path))
+
+    def on_result(chunk_id, result):
+        if chunk_id in screen_results:
+            result.update(screen_results[chunk_id])
+        if save_result and 'error' not in result:
+            append_checkpoint(checkpoint_path, chunk_id, summary_dict[chunk_id], result)
+
+    # source-side artifacts are shared with the other styles of the same book through cache_dir
+    result_dict.update(run_with_judge_models(a_measure_chunks(pending_dict, max_concurrency=max_concurrency,
+                                                              cache_dir=cache_dir, merged_answers=merged_answers,
+                                                              truths_window_tokens=truths_window_tokens,
+                                                              on_result=on_result)))
+    # keep the chunk order of the summary file
+    result_dict = {chunk_id: result_dict[chunk_id] for chunk_id in summary_dict}
+
+    # save_result
+    if save_result:
+        with open(osp.join(osp.dirname(summary_path), f'eval_results_{summary_style}.json'), 'w') as f:
+            json.dump(result_dict, f)
+        save_checkpoint(checkpoint_path, summary_dict, result_dict)
+
+    return result_dict
+
+def get_summary_style(summary_path):
+    """
+    Get the summary style from a summary_{style}.json file name.
+    """
+    match = re.match(r'summary_(.+)\.json$', osp.basename(summary_path))
+    assert match is not None, f'Cannot infer summary style from {summary_path}'
+    return match.group(1)
+
+def expand_summary_paths(patterns):
+    summary_paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        summary_paths.extend(matches if matches else [pattern])
+    # keep order, drop duplicates
+    return list(dict.fromkeys(summary_paths))
+
+async def a_eval_multiple_summaries(summary_paths, max_concurrency=20, save_result=True, cache_dir=None,
+                                    merged_answers=False, prescreen_config=None, truths_window_tokens=None,
+                                    resume=True):
+    """
+    Evaluate several summary files in one process. Test cases of all books share one
+    semaphore, so at most max_concurrency test cases are measured at the same time.
+    Each eval_results_{style}.json is written as soon as its book finishes, and every
+    LLM result is checkpointed as soon as its test case finishes.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # one lock per source text, so the first style fills the source cache and the others reuse it
+    source_locks = {}
+
+    books = []
+    for summary_path in summary_paths:
+        summary_dict = load_summary_file(summary_path)
+        summary_dict = {k: v for k, v in summary_dict.items() if v['text'] != ''}
+        books.append((summary_path, get_summary_style(summary_path), summary_dict))
 
-    for _, item in summary_dict.items():
-        if item['text'] == '':
+    # chunks scored by a previous run on the same text and summary are not judged again
+    restored = {}
+    for summary_path, summary_style, summary_dict in books:
+        restored[summary_path] = load_checkpoint(get_checkpoint_path(summary_path, summary_style),
+                                                 summary_dict) if resume else {}
+        if len(restored[summary_path]) > 0:
+            print(f'{len(restored[summary_path])} chunks of {summary_path} restored from checkpoint')
+
+    # prescreen the chunks of all books in one batch
+    screen_results = {}
+    if prescreen_config is not None:
+        screen_results = prescreen_chunks({(book[0], chunk_id): chunk for book in books
+                                           for chunk_id, chunk in book[2].items()
+                                           if chunk_id not in restored[book[0]]}, prescreen_config)
+        n_local = sum(1 for e in screen_results.values() if e['tier'] == 'local')
+        print(f'{n_local} chunks scored locally, {len(screen_results) - n_local} chunks sent to the LLM judge')
+
+    def needs_llm(summary_path, chunk_id):
+        if chunk_id in restored[summary_path]:
+            return False
+        key = (summary_path, chunk_id)
+        return key not in screen_results or screen_results[key]['tier'] == 'llm'
+
+    progress = {'done': 0, 'start': time.time(),
+                'total': sum(1 for book in books for chunk_id in book[2] if needs_llm(book[0], chunk_id))}
+
+    async def measure(test_case):
+        result = await a_measure_test_case(test_case, semaphore, source_locks, cache_dir=cache_dir,
+                                           merged_answers=merged_answers,
+                                           truths_window_tokens=truths_window_tokens)
+
+        progress['done'] += 1
+        elapsed = time.time() - progress['start']
+        print(f"\rEvaluated {progress['done']}/{progress['total']} test cases "
+              f"({progress['done'] / elapsed:.2f} test cases/s, {elapsed:.0f}s elapsed)", end='', flush=True)
+        return result
+
+    async def eval_book(summary_path, summary_style, summary_dict):
+        checkpoint_path = get_checkpoint_path(summary_path, summary_style)
+        if save_result:
+            mkdir_if_not_exists(osp.dirname(summary_path))
+
+        result_dict = dict(restored[summary_path])
+        llm_chunk_ids = []
+        for chunk_id in summary_dict:
+            if needs_llm(summary_path, chunk_id):
+                llm_chunk_ids.append(chunk_id)
+            elif chunk_id not in result_dict:
+                result_dict[chunk_id] = get_local_result(screen_results[(summary_path, chunk_id)], prescreen_config)
+
+        async def measure_chunk(chunk_id):
+            chunk = summary_dict[chunk_id]
+            result = await measure(LLMTestCase(input=chunk['text'], actual_output=chunk['summary']))
+            if (summary_path, chunk_id) in screen_results:
+                result.update(screen_results[(summary_path, chunk_id)])
+            if save_result and 'error' not in result:
+                append_checkpoint(checkpoint_path, chunk_id, chunk, result)
+            return result
+
+        results = await asyncio.gather(*[measure_chunk(chunk_id) for chunk_id in llm_chunk_ids])
+        result_dict.update(zip(llm_chunk_ids, results))
+        # keep the chunk order of the summary file
+        result_dict = {chunk_id: result_dict[chunk_id] for chunk_id in summary_dict}
+
+        if save_result:
+            with open(osp.join(osp.dirname(summary_path), f'eval_results_{summary_style}.json'), 'w') as f:
+                json.dump(result_dict, f)
+            save_checkpoint(checkpoint_path, summary_dict, result_dict)
+            print(f'\nSaved evaluation results of {summary_path}')
+
+        return result_dict
+
+    results = await asyncio.gather(*[eval_book(*book) for book in books])
+    print()
+    return dict(zip([book[0] for book in books], results))
+
+def eval_multiple_summaries(summary_paths, max_concurrency=20, save_result=True, cache_dir=None,
+                            merged_answers=False, prescreen_config=None, truths_window_tokens=None, resume=True):
+    return run_with_judge_models(a_eval_multiple_summaries(summary_paths, max_concurrency=max_concurrency,
+                                                           save_result=save_result, cache_dir=cache_dir,
+                                                           merged_answers=merged_answers,
+                                                           prescreen_config=prescreen_config,
+                                                           truths_window_tokens=truths_window_tokens,
+                                                           resume=resume))
+
+def get_strata(summary_dict, n_length_bins=3):
+    """
+    Group chunk ids into strata by TOC level and text length quantile.
+    """
+    chunk_ids = list(summary_dict.keys())
+    lengths = np.array([len(summary_dict[k]['text']) for k in chunk_ids])
+    edges = np.quantile(lengths, np.linspace(0, 1, n_length_bins + 1)[1:-1]) if len(lengths) > 0 else []
+    length_bins = np.digitize(lengths, edges)
+
+    strata = {}
+    for chunk_id, length_bin in zip(chunk_ids, length_bins):
+        key = f"level_{summary_dict[chunk_id]['level']}_length_{length_bin}"
+        strata.setdefault(key, []).append(chunk_id)
+    return strata
+
+def draw_stratified_sample(strata, sample_size, rng, sampled=None, min_per_stratum=2):
+    """
+    Draw sample_size chunk ids not in sampled, allocated to strata in proportion to their
+    size. While the sample size allows it, each stratum is topped up to min_per_stratum
+    sampled chunks, or all of its chunks: a single score gives a stratum no variance.
+    """
+    sampled = set() if sampled is None else sampled
+    remaining = {k: [c for c in v if c not in sampled] for k, v in strata.items()}
+    remaining = {k: v for k, v in remaining.items() if len(v) > 0}
+    n_remaining = sum(len(v) for v in remaining.values())
+    sample_size = min(sample_size, n_remaining)
+    if sample_size == 0:
+        return []
+
+    # largest remainder allocation
+    quotas = {k: sample_size * len(v) / n_remaining for k, v in remaining.items()}
+    minimum = {k: max(1, min_per_stratum - (len(strata[k]) - len(remaining[k]))) for k in remaining}
+    allocation = {k: min(len(remaining[k]), max(minimum[k], int(q))) for k, q in quotas.items()}
+    while sum(allocation.values()) > sample_size:
+        k = max(allocation, key=lambda k: allocation[k] - quotas[k])
+        allocation[k] -= 1
+    while sum(allocation.values()) < sample_size:
+        k = max((k for k in allocation if allocation[k] < len(remaining[k])), key=lambda k: quotas[k] - allocation[k])
+        allocation[k] += 1
+
+    sample = []
+    for k, n in allocation.items():
+        if n > 0:
+            sample.extend(rng.choice(remaining[k], size=n, replace=False).tolist())
+    return sample
+
+def bootstrap_stratified_mean(strata, scores, n_bootstrap=2000, confidence=0.95, rng=None):
+    """
+    Stratified estimate of the book-level mean score with a percentile bootstrap confidence
+    interval. Strata are weighted by their size, scores are resampled within each stratum,
+    and strata with a single score out of several chunks are resampled together.
+
+    Args:
+        strata (dict): Stratum key to all chunk ids of the stratum
+        scores (dict): Chunk id to score, for the sampled chunks
+    """
+    rng = np.random.default_rng() if rng is None else rng
+
+    # a single score of a larger stratum has no spread to resample, such strata are pooled
+    groups = []
+    pooled_size, pooled_scores = 0, []
+    for chunk_ids in strata.values():
+        stratum_scores = [scores[c] for c in chunk_ids if c in scores]
+        if len(stratum_scores) == 0:
             continue
+        if len(stratum_scores) == 1 and len(chunk_ids) > 1:
+            pooled_size += len(chunk_ids)
+            pooled_scores.extend(stratum_scores)
+        else:
+            groups.append((len(chunk_ids), stratum_scores))
+    if len(pooled_scores) > 0:
+        groups.append((pooled_size, pooled_scores))
+
+    weights = []
+    bootstrap_means = []
+    point_estimate = 0
+    for size, stratum_scores in groups:
+        stratum_scores = np.array(stratum_scores, dtype=float)
+        weights.append(size)
+        point_estimate += size * stratum_scores.mean()
+        idx = rng.integers(0, len(stratum_scores), size=(n_bootstrap, len(stratum_scores)))
+        bootstrap_means.append(stratum_scores[idx].mean(axis=1))
 
-        original_text = item['text']
-        summary = item['summary']
+    if len(weights) == 0:
+        return {'mean': None, 'ci_low': None, 'ci_high': None, 'ci_width': None}
 
-        test_case = LLMTestCase(input=original_text, actual_output=summary)
-        test_cases.append(test_case)
+    # strata without any scored chunk are left out and the others re-weighted
+    weights = np.array(weights, dtype=float)
+    estimates = np.array(bootstrap_means).T @ weights / weights.sum()
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(estimates, [alpha, 1 - alpha])
 
-    custom_summarization_metric = CustomSummarizationMetric(n_complex_questions = 3, 
-                                                            verbose_mode=False)
+    # a lone sampled chunk cannot tell how much its strata vary, the interval is not trusted yet
+    if len(pooled_scores) == 1:
+        return {'mean': float(point_estimate / weights.sum()), 'ci_low': None, 'ci_high': None, 'ci_width': None}
 
-    eval_result = evaluate(test_cases, [custom_summarization_metric])
+    return {
+        'mean': float(point_estimate / weights.sum()),
+        'ci_low': float(ci_low),
+        'ci_high': float(ci_high),
+        'ci_width': float(ci_high - ci_low),
+    }
+
+async def a_measure_chunks(chunks, max_concurrency=20, cache_dir=None, merged_answers=False,
+                           truths_window_tokens=None, on_result=None):
+    """
+    Measure chunks concurrently. on_result(chunk_id, result) is called as each chunk finishes.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    source_locks = {}
+
+    async def measure(chunk_id, chunk):
+        result = await a_measure_test_case(LLMTestCase(input=chunk['text'], actual_output=chunk['summary']),
+                                           semaphore, source_locks, cache_dir=cache_dir,
+                                           merged_answers=merged_answers,
+                                           truths_window_tokens=truths_window_tokens)
+
+        if on_result is not None:
+            on_result(chunk_id, result)
+        return result
+
+    results = await asyncio.gather(*[measure(chunk_id, chunk) for chunk_id, chunk in chunks.items()])
+    return dict(zip(chunks.keys(), results))
+
+def eval_summaries_sampled(summary_path, summary_style, sample_size=30, target_ci_width=None, batch_size=10,
+                           confidence=0.95, n_length_bins=3, max_concurrency=20, seed=0,
+                           save_result=True, cache_dir=None, merged_answers=False, truths_window_tokens=None):
+    """
+    Estimate the book-level mean score from a stratified sample of chunks instead of judging
+    every chunk. With target_ci_width, keep sampling batch_size more chunks until the
+    confidence interval is narrower than the target or every chunk is scored.
+    """
+    summary_dict = load_summary_file(summary_path)
+
+    summary_dict = {k: v for k, v in summary_dict.items() if v['text'] != ''}
+
+    rng = np.random.default_rng(seed)
+    strata = get_strata(summary_dict, n_length_bins=n_length_bins)
 
     result_dict = {}
+    scores = {}
+    estimate = bootstrap_stratified_mean(strata, scores)
+    next_sample_size = sample_size
+    while True:
+        sample = draw_stratified_sample(strata, next_sample_size, rng, sampled=set(result_dict))
+        if len(sample) == 0:
+            break
 
-    for i, chunk_id in enumerate(summary_dict.keys()):
-        summarization_metric_logs = json.loads(eval_result.test_results[i].metrics_data[0].verbose_logs)
-        result_dict[chunk_id] = summarization_metric_logs
+        results = run_with_judge_models(a_measure_chunks({k: summary_dict[k] for k in sample},
+                                                         max_concurrency=max_concurrency, cache_dir=cache_dir, merged_answers=merged_answers,
+                                                         truths_window_tokens=truths_window_tokens))
+        result_dict.update(results)
+
+        scores = {k: v['score'] for k, v in result_dict.items() if 'score' in v}
+        estimate = bootstrap_stratified_mean(strata, scores, confidence=confidence, rng=rng)
+        print(f"Scored {len(scores)}/{len(summary_dict)} chunks, mean = {estimate['mean']}, "
+              f"{confidence:.0%} CI = [{estimate['ci_low']}, {estimate['ci_high']}]")
+
+        if target_ci_width is None or (estimate['ci_width'] is not None and estimate['ci_width'] <= target_ci_width):
+            break
+        next_sample_size = batch_size
+
+    estimate.update({
+        'confidence': confidence,
+        'n_sampled': len(scores),
+        'n_total': len(summary_dict),
+        'strata': {k: {'size': len(v), 'sampled': sum(1 for c in v if c in scores)} for k, v in strata.items()},
+    })
 
-    # save_result
     if save_result:
         save_dir = osp.dirname(summary_path)
         mkdir_if_not_exists(save_dir)
-        with open(osp.join(save_dir, f'eval_results_{summary_style}.json'), 'w') as f:
-            json.dump(result_dict, f)
+        with open(osp.join(save_dir, f'eval_results_{summary_style}_sampled.json'), 'w') as f:
+            json.dump({'estimate': estimate, 'chunks': result_dict}, f)
 
-    return result_dict
+    return estimate, result_dict
 
 if __name__ == '__main__':
     # summary_path = 'outputs/Self-Development/Atomic Habits/summary.json'
 
     parser = argparse.ArgumentParser(description="Book summarizer")
     parser.add_argument('--style', type=str, default='analytic', help='summary style')
-    parser.add_argument('--summary_path', type=str, required=True, help='document path')
+    parser.add_argument('--summary_path', type=str, default=None, help='document path')
+    parser.add_argument('--summary_paths', type=str, nargs='+', default=None,
+                        help='summary files or glob patterns to evaluate in one process, style is read from the file name')
+    parser.add_argument('--max_concurrency', type=int, default=20, help='maximum number of test cases measured at once')
+    parser.add_argument('--no_cache', action='store_true', help='do not reuse source-side artifacts across styles')
+    parser.add_argument('--merged_answers', action='store_true',
+                        help='answer the questions on the original text and the summary in one request')
+    parser.add_argument('--prescreen', action='store_true',
+                        help='score clear-cut chunks with local metrics and only send uncertain ones to the LLM judge')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='score every chunk again instead of resuming from the checkpoint')
+    parser.add_argument('--truths_window_tokens', type=int, default=None,
+                        help='extract truths from windows of this many tokens for longer source texts')
+    parser.add_argument('--sample_size', type=int, default=None,
+                        help='only judge a stratified sample of this many chunks and estimate the book-level mean')
+    parser.add_argument('--target_ci_width', type=float, default=None,
+                        help='keep sampling until the confidence interval is narrower than this')
+    parser.add_argument('--batch_size', type=int, default=10, help='chunks added per round when sampling adaptively')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the interval')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the sampling')
     
     args = parser.parse_args()
-    eval_summaries(args.summary_path, args.style)
\ No newline at end of file
+    assert args.summary_path or args.summary_paths, 'Either --summary_path or --summary_paths is required'
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    cache_dir = None if args.no_cache else config['EVAL_CACHE_DIR']
+    prescreen_config = config['LOCAL_METRICS'] if args.prescreen else None
+
+    if args.summary_paths:
+        eval_multiple_summaries(expand_summary_paths(args.summary_paths),
+                                max_concurrency=args.max_concurrency, cache_dir=cache_dir,
+                                merged_answers=args.merged_answers, prescreen_config=prescreen_config,
+                                truths_window_tokens=args.truths_window_tokens, resume=not args.no_resume)
+    elif args.sample_size is not None:
+        eval_summaries_sampled(args.summary_path, args.style, sample_size=args.sample_size,
+                               target_ci_width=args.target_ci_width, batch_size=args.batch_size,
+                               confidence=args.confidence, max_concurrency=args.max_concurrency, seed=args.seed,
+                               cache_dir=cache_dir, merged_answers=args.merged_answers,
+                               truths_window_tokens=args.truths_window_tokens)
+    else:
+        eval_summaries(args.summary_path, args.style, cache_dir=cache_dir,
+                       merged_answers=args.merged_answers, prescreen_config=prescreen_config,
+                       truths_window_tokens=args.truths_window_tokens, max_concurrency=args.max_concurrency,
+                       resume=not args.no_resume)
\ No newline at end of file
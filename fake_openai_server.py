@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import argparse
+
+# a silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, 1152 samples
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+# speaking rate used to size the audio of a text
+CHARS_PER_SECOND = 15
+
+# how judge prompts without a response schema name the JSON they expect
+KEY_PATTERNS = [re.compile(e) for e in [
+    r"with (?:the |a )?key ['\"](\w+)['\"]",
+    r"with (?:the |a )?['\"](\w+)['\"] key",
+]]
+FIELDS_PATTERNS = [re.compile(e) for e in [
+    r"with the keys:? ((?:['\"]\w+['\"],? ?(?:and )?)+)",
+    r"\d+ fields: ((?:['\"]\w+['\"],? ?(?:and )?)+)",
+    r"keys ((?:['\"]\w+['\"],? ?(?:and )?)+)",
+]]
+
+WORDS = ('the book argues that habits compound over time and small changes in daily routines '
+         'lead to large differences in outcomes the author explains each idea with examples').split()
+
+
+class FakeOpenAIServer:
+    """
+    Minimal OpenAI-compatible HTTP server for load tests: chat completions, with JSON
+    answers shaped after the requested schema or the keys named in the prompt, and
+    text to speech.
+    Responses are delayed by a configurable latency distribution and a share of
+    requests fails with 429 or 5xx errors.
+    """
+    def __init__(self, latency='lognormal', latency_ms=300, jitter=0.5, ms_per_token=0.0,
+                 rate_429=0.0, rate_5xx=0.0, array_items=5, completion_words=120, seed=0):
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.ms_per_token = ms_per_token
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.array_items = array_items
+        self.completion_words = completion_words
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        # system prompts seen so far, to report prompt cache hits like the API does
+        self.prefixes = set()
+        self.stats = {'requests': 0, 'connections': 0, 'max_in_flight': 0, 'status': {}, 'paths': {}}
+        self.in_flight = 0
+
+    def _get_delay(self, output_tokens):
+        """Seconds to wait before answering, from the latency distribution"""
+        if self.latency == 'constant':
+            delay = self.latency_ms
+        elif self.latency == 'uniform':
+            delay = self.random.uniform(self.latency_ms * (1 - self.jitter), self.latency_ms * (1 + self.jitter))
+        else:
+            # latency_ms is the median, jitter the sigma of the underlying normal
+            delay = self.random.lognormvariate(0, self.jitter) * self.latency_ms
+        return (delay + output_tokens * self.ms_per_token) / 1000
+
+    def _count_tokens(self, text):
+        # close enough to the tokenizers for usage reports
+        return max(1, len(text) // 4)
+
+    def _get_text(self, n_words, seed_text):
+        rng = random.Random(hashlib.sha256(seed_text.encode('utf-8')).hexdigest())
+        return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + '.'
+
+    def _get_instance(self, schema, defs, name=''):
+        """A value that validates against a JSON schema, as produced by pydantic"""
+        if '$ref' in schema:
+            return self._get_instance(defs[schema['$ref'].split('/')[-1]], defs, name)
+        if 'anyOf' in schema:
+            return self._get_instance(schema['anyOf'][0], defs, name)
+        if 'enum' in schema:
+            return self.random.choice(schema['enum'])
+
+        schema_type = schema.get('type')
+        if schema_type == 'object':
+            return {key: self._get_instance(value, defs, key) for key, value in schema.get('properties', {}).items()}
+        if schema_type == 'array':
+            return [self._get_instance(schema.get('items', {}), defs, name) for _ in range(self.array_items)]
+        if schema_type == 'integer':
+            return self.random.randint(schema.get('minimum', 1), schema.get('maximum', 5))
+        if schema_type == 'number':
+            return self.random.random()
+        if schema_type == 'boolean':
+            return self.random.random() < 0.5
+        return self._get_value(name)
+
+    def _get_value(self, name):
+        if name in ('verdict', 'original_verdict', 'summary_verdict'):
+            return self.random.choice(['yes', 'no'])
+        if name in ('score', 'importance'):
+            return self.random.randint(1, 5)
+        return self._get_text(8, f'{name}{self.random.random()}')
+
+    def _get_prompt_instance(self, prompt):
+        """
+        JSON for a prompt that asks for it in words instead of a response schema, as the
+        deepeval judge templates do: the key the prompt names, holding a list of objects
+        with the fields it names, a list of strings, or a string for a 'reason'.
+        """
+        key = next((m.group(1) for m in (e.search(prompt) for e in KEY_PATTERNS) if m), None)
+        if key is None:
+            return None
+        if key == 'reason':
+            return {key: self._get_text(12, prompt)}
+
+        fields = next((m.group(1) for m in (e.search(prompt) for e in FIELDS_PATTERNS) if m), None)
+        if fields is None:
+            items = [self._get_value(key) for _ in range(self.array_items)]
+        else:
+            names = re.findall(r"['\"](\w+)['\"]", fields)
+            items = [{name: self._get_value(name) for name in names} for _ in range(self.array_items)]
+        return {key: items}
+
+    def _chat_completion(self, body):
+        messages = body.get('messages', [])
+        prompt = '\n'.join(str(e.get('content', '')) for e in messages)
+        response_format = body.get('response_format') or {}
+
+        instance = self._get_prompt_instance(prompt)
+        if response_format.get('type') == 'json_schema':
+            schema = response_format['json_schema']['schema']
+            content = json.dumps(self._get_instance(schema, schema.get('$defs', {})))
+        elif instance is not None:
+            content = json.dumps(instance)
+        elif response_format.get('type') == 'json_object':
+            content = json.dumps({'result': self._get_text(10, prompt)})
+        else:
+            n_words = self.completion_words
+            if body.get('max_tokens'):
+                n_words = min(n_words, int(body['max_tokens'] * 0.75))
+            content = self._get_text(n_words, prompt)
+
+        prompt_tokens = self._count_tokens(prompt)
+        completion_tokens = self._count_tokens(content)
+
+        # a system prompt seen before is served from the cache, in blocks of 128 tokens past 1024
+        cached_tokens = 0
+        system = ''.join(str(e.get('content', '')) for e in messages if e.get('role') == 'system')
+        if system in self.prefixes:
+            system_tokens = self._count_tokens(system)
+            cached_tokens = system_tokens // 128 * 128 if system_tokens >= 1024 else 0
+        elif system:
+            self.prefixes.add(system)
+
+        return completion_tokens, {
+            'id': f'chatcmpl-{self.stats["requests"]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content, 'refusal': None},
+                'finish_reason': 'stop',
+                'logprobs': None,
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens},
+            },
+        }
+
+    def _speech(self, body):
+        seconds = max(1.0, len(body.get('input', '')) / CHARS_PER_SECOND)
+        return MP3_FRAME * int(seconds * MP3_FRAMES_PER_SECOND)
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, path.split('?')[0], body
+
+    async def _write_response(self, writer, status, body, content_type='application/json', headers=None,
+                              chunk_size=None):
+        reasons = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error',
+                   503: 'Service Unavailable'}
+        head = [f'HTTP/1.1 {status} {reasons.get(status, "Error")}', f'Content-Type: {content_type}',
+                f'Content-Length: {len(body)}']
+        head += [f'{key}: {value}' for key, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+        # audio is sent in pieces, as the API streams it
+        chunk_size = chunk_size or len(body) or 1
+        for i in range(0, len(body), chunk_size):
+            writer.write(body[i:i + chunk_size])
+            await writer.drain()
+        await writer.drain()
+
+    def _count(self, path, status):
+        self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+        self.stats['paths'][path] = self.stats['paths'].get(path, 0) + 1
+
+    async def _handle(self, method, path, raw_body, writer):
+        if path == '/stats':
+            return await self._write_response(writer, 200, json.dumps(self.stats).encode('utf-8'))
+        if path == '/reset':
+            self.reset()
+            return await self._write_response(writer, 200, b'{}')
+
+        self.stats['requests'] += 1
+        body = json.loads(raw_body or b'{}')
+
+        draw = self.random.random()
+        if draw < self.rate_429:
+            await asyncio.sleep(self._get_delay(0) / 4)
+            self._count(path, 429)
+            error = {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error', 'code': 'rate_limit_exceeded'}}
+            return await self._write_response(writer, 429, json.dumps(error).encode('utf-8'),
+                                              headers={'retry-after-ms': '200'})
+        if draw < self.rate_429 + self.rate_5xx:
+            await asyncio.sleep(self._get_delay(0))
+            status = self.random.choice([500, 503])
+            self._count(path, status)
+            error = {'error': {'message': 'The server had an error', 'type': 'server_error', 'code': None}}
+            return await self._write_response(writer, status, json.dumps(error).encode('utf-8'))
+
+        if path.endswith('/chat/completions'):
+            output_tokens, response = self._chat_completion(body)
+            await asyncio.sleep(self._get_delay(output_tokens))
+            self._count(path, 200)
+            return await self._write_response(writer, 200, json.dumps(response).encode('utf-8'))
+        if path.endswith('/audio/speech'):
+            audio = self._speech(body)
+            await asyncio.sleep(self._get_delay(0))
+            self._count(path, 200)
+            return await self._write_response(writer, 200, audio, content_type='audio/mpeg', chunk_size=16384)
+
+        self._count(path, 404)
+        await self._write_response(writer, 404, b'{"error": {"message": "Not found"}}')
+
+    async def _serve_connection(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                self.in_flight += 1
+                self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+                try:
+                    await self._handle(*request, writer)
+                finally:
+                    self.in_flight -= 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, ready=None):
+        server = await asyncio.start_server(self._serve_connection, host, port, backlog=1024)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(settings, host='127.0.0.1', port=8765, ready=None):
+    """Run a server with the given settings until the process is stopped"""
+    asyncio.run(FakeOpenAIServer(**settings).serve(host, port, ready))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible server for load tests")
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--latency', type=str, default='lognormal', choices=['constant', 'uniform', 'lognormal'],
+                        help='latency distribution')
+    parser.add_argument('--latency_ms', type=float, default=300, help='median latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='sigma of the lognormal latency, or relative half-width of the uniform one')
+    parser.add_argument('--ms_per_token', type=float, default=0.0, help='extra latency per completion token')
+    parser.add_argument('--rate_429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help='share of requests answered with 500 or 503')
+
+    args = parser.parse_args()
+
+    settings = {key: value for key, value in vars(args).items() if key != 'port'}
+    print(f'Serving on http://127.0.0.1:{args.port}/v1 with {settings}')
+    run_server(settings, port=args.port)
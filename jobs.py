@@ -0,0 +1,322 @@
+import json
+import os.path as osp
+import time
+import socket
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+from document import PDF_Document
+from summarizer import Summarizer
+from database import get_db_connection, get_summary_version, insert_summary, init_blob_table
+from utils import mkdir_if_not_exists
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobLost(Exception):
+    """Raised in a worker whose job was requeued as stale and may be run by another worker"""
+
+
+class HeartbeatSummarizer(Summarizer):
+    """
+    Summarizer that sends the heartbeat of the job it runs before and after every
+    completion request, so a slow request or retry does not make the job look stale.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.heartbeat = None
+
+    def _get_completion(self, *args, **kwargs):
+        if self.heartbeat is not None:
+            self.heartbeat()
+        response = super()._get_completion(*args, **kwargs)
+        if self.heartbeat is not None:
+            self.heartbeat()
+        return response
+
+
+def init_job_tables(conn):
+    """Create the job queue tables"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                book_id INTEGER,
+                content_hash TEXT,
+                doc_path TEXT,
+                summary_style TEXT,
+                prompt_file TEXT,
+                status TEXT,
+                total_chunks INTEGER,
+                done_chunks INTEGER DEFAULT 0,
+                error TEXT,
+                worker TEXT,
+                summary_id INTEGER,
+                created_at TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                heartbeat_at TIMESTAMP,
+                FOREIGN KEY (book_id) REFERENCES books (id),
+                FOREIGN KEY (summary_id) REFERENCES summaries (id)
+            )
+        ''')
+
+        # chunk summaries of a job as they are done, so progress survives worker restarts
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_chunks (
+                job_id INTEGER,
+                chunk_order INTEGER,
+                title TEXT,
+                level INTEGER,
+                summary TEXT,
+                PRIMARY KEY (job_id, chunk_order),
+                FOREIGN KEY (job_id) REFERENCES jobs (id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+        conn.execute('DROP INDEX IF EXISTS idx_jobs_book')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_edition ON jobs (book_id, content_hash, summary_style)')
+
+
+def _to_dict(cursor, row):
+    if row is None:
+        return None
+    return {e[0]: value for e, value in zip(cursor.description, row)}
+
+
+def get_upload_path(config, content_hash, file_name):
+    """Where an uploaded book is kept for the workers, one directory per content hash"""
+    return osp.join(mkdir_if_not_exists(osp.join(config['JOBS']['UPLOAD_DIR'], content_hash)), file_name)
+
+
+def submit_job(conn, book_id, content_hash, doc_path, summary_style, prompt_file):
+    """
+    Queue a summary job. An edition of a book, identified by its content hash, and a
+    style only have one active job at a time, submitting it again returns the job
+    already queued or running.
+
+    Returns:
+        int: Id of the job
+    """
+    with conn:
+        job = find_active_job(conn, book_id, content_hash, summary_style)
+        if job is not None:
+            return job['id']
+
+        c = conn.execute('''
+            INSERT INTO jobs (book_id, content_hash, doc_path, summary_style, prompt_file, status, created_at)
+            VALUES (?, ?, ?, ?, ?, 'queued', ?)
+        ''', (book_id, content_hash, doc_path, summary_style, prompt_file, datetime.now()))
+    return c.lastrowid
+
+
+def get_job(conn, job_id):
+    c = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+    return _to_dict(c, c.fetchone())
+
+
+def find_active_job(conn, book_id, content_hash, summary_style):
+    """The queued or running job of an edition of a book and a style, if any"""
+    c = conn.execute('''
+        SELECT * FROM jobs WHERE book_id = ? AND content_hash = ? AND summary_style = ? AND status IN (?, ?)
+        ORDER BY id DESC LIMIT 1
+    ''', (book_id, content_hash, summary_style, *ACTIVE_STATUSES))
+    return _to_dict(c, c.fetchone())
+
+
+def get_job_chunks(conn, job_id):
+    """The chunk summaries a job has finished so far, in document order"""
+    c = conn.execute('''
+        SELECT chunk_order, title, level, summary FROM job_chunks WHERE job_id = ? ORDER BY chunk_order
+    ''', (job_id,))
+    return {row[0]: {'title': row[1], 'level': row[2], 'summary': row[3]} for row in c.fetchall()}
+
+
+def claim_job(conn, worker):
+    """
+    Atomically take the oldest queued job, or return None if there is none.
+    """
+    with conn:
+        c = conn.execute('''
+            UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?
+            WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+            RETURNING *
+        ''', (worker, datetime.now(), datetime.now()))
+        job = _to_dict(c, c.fetchone())
+    return job
+
+
+def requeue_stale_jobs(conn, stale_after):
+    """
+    Put running jobs back in the queue when their worker stopped sending heartbeats,
+    e.g. because it was killed. They resume from their last finished chunk.
+    """
+    with conn:
+        c = conn.execute('''
+            UPDATE jobs SET status = 'queued', worker = NULL
+            WHERE status = 'running' AND heartbeat_at < ?
+        ''', (datetime.now() - timedelta(seconds=stale_after),))
+    return c.rowcount
+
+
+def send_heartbeat(conn, job_id, worker):
+    """
+    Tell that the worker still runs the job. Raises JobLost if the job was requeued in
+    the meantime, the worker must then stop working on it.
+    """
+    with conn:
+        c = conn.execute('''
+            UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = 'running'
+        ''', (datetime.now(), job_id, worker))
+    if c.rowcount == 0:
+        raise JobLost(f'Job {job_id} is no longer run by {worker}')
+
+
+def requeue_job(conn, job_id, worker):
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ? AND worker = ?",
+                     (job_id, worker))
+
+
+def fail_job(conn, job_id, worker, error):
+    with conn:
+        conn.execute('''
+            UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ? AND worker = ?
+        ''', (error, datetime.now(), job_id, worker))
+
+
+def run_job(conn, config, summarizer, job):
+    """
+    Summarize the chunks of a job one by one, storing each summary and the progress as
+    it is done. The finished summary is written to the summaries tables like a summary
+    generated in the app.
+    Every write checks that the job is still run by this worker: a job requeued as
+    stale raises JobLost instead of being written twice.
+    """
+    job_id, worker = job['id'], job['worker']
+
+    def heartbeat():
+        send_heartbeat(conn, job_id, worker)
+
+    heartbeat()
+    document = PDF_Document(file_path=job['doc_path'], config=config)
+    summary_prompt = summarizer._load_prompt(osp.join(config['PROMPT_DIR'], job['prompt_file']))
+    context = summarizer._get_book_context(document)
+    heartbeat()
+
+    chunks = document.contents
+    # a requeued job skips the chunks it already summarized
+    done = get_job_chunks(conn, job_id)
+    with conn:
+        conn.execute('UPDATE jobs SET total_chunks = ?, done_chunks = ? WHERE id = ? AND worker = ?',
+                     (len(chunks), len(done), job_id, worker))
+
+    summarizer.heartbeat = heartbeat
+    try:
+        for chunk_id, chunk in chunks.items():
+            if int(chunk_id) in done:
+                continue
+
+            chunk = summarizer._get_chunk_summaries(chunks={chunk_id: chunk}, summary_prompt=summary_prompt,
+                                                    context=context, prompt_file=job['prompt_file'])[chunk_id]
+            with conn:
+                c = conn.execute('''
+                    UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = 'running'
+                ''', (datetime.now(), job_id, worker))
+                if c.rowcount == 0:
+                    raise JobLost(f'Job {job_id} is no longer run by {worker}')
+                conn.execute('''
+                    INSERT OR REPLACE INTO job_chunks (job_id, chunk_order, title, level, summary)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (job_id, int(chunk_id), chunk['title'], chunk['level'], chunk['summary']))
+                conn.execute('''
+                    UPDATE jobs SET done_chunks = (SELECT COUNT(*) FROM job_chunks WHERE job_id = ?) WHERE id = ?
+                ''', (job_id, job_id))
+    finally:
+        summarizer.heartbeat = None
+
+    summary_json = get_job_chunks(conn, job_id)
+    prompt_hash, routing_hash = get_summary_version(config, job['prompt_file'])
+
+    # the summary and the job status are written in one transaction, which is rolled back
+    # if the job was taken over in the meantime
+    with conn:
+        c = conn.execute('''
+            UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND worker = ? AND status = 'running'
+        ''', (datetime.now(), job_id, worker))
+        if c.rowcount == 0:
+            raise JobLost(f'Job {job_id} is no longer run by {worker}')
+        summary_id = insert_summary(conn, job['book_id'], job['summary_style'], job['content_hash'],
+                                    prompt_hash, routing_hash, summary_json)
+        conn.execute('UPDATE jobs SET summary_id = ? WHERE id = ?', (summary_id, job_id))
+        # the summaries are kept in chunk_summaries from now on
+        conn.execute('DELETE FROM job_chunks WHERE job_id = ?', (job_id,))
+    return summary_id
+
+
+def work(config, db_file, worker):
+    """
+    Worker loop: take queued jobs and run them until interrupted.
+    """
+    conn = get_db_connection(db_file)
+    init_blob_table(conn)
+    init_job_tables(conn)
+    summarizer = HeartbeatSummarizer(config)
+
+    while True:
+        requeued = requeue_stale_jobs(conn, config['JOBS']['STALE_AFTER'])
+        if requeued > 0:
+            print(f'[{worker}] Requeued {requeued} stale jobs')
+
+        job = claim_job(conn, worker)
+        if job is None:
+            time.sleep(config['JOBS']['POLL_INTERVAL'])
+            continue
+
+        start = time.time()
+        print(f'[{worker}] Running job {job["id"]}: {osp.basename(job["doc_path"])} ({job["summary_style"]})')
+        try:
+            run_job(conn, config, summarizer, job)
+            print(f'[{worker}] Job {job["id"]} done in {time.time() - start:.1f}s')
+        except KeyboardInterrupt:
+            # hand the job over to the next worker right away instead of waiting for it to go stale
+            requeue_job(conn, job['id'], worker)
+            raise
+        except JobLost as e:
+            # another worker may be running the job, it is left to that worker
+            print(f'[{worker}] {e}')
+        except Exception as e:
+            fail_job(conn, job['id'], worker, str(e))
+            print(f'[{worker}] Job {job["id"]} failed: {e}')
+
+
+def _work(config, db_file, worker):
+    try:
+        work(config, db_file, worker)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summary job workers")
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--db_file', type=str, default='books.db', help='database of the app')
+
+    args = parser.parse_args()
+
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    host = socket.gethostname()
+    processes = [multiprocessing.Process(target=_work, args=(config, args.db_file, f'{host}-{i}'))
+                 for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    print(f'Started {args.workers} workers on {args.db_file}')
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import weakref
+from typing import Optional, Union
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from deepeval.models import DeepEvalBaseLLM, GPTModel
+from deepeval.metrics.utils import initialize_model
+
+# connection pool shared by every judge request of the process
+MAX_CONNECTIONS = 100
+KEEPALIVE_EXPIRY = 30
+
+_lock = threading.Lock()
+_models = {}
+
+
+class PooledGPTModel(GPTModel):
+    """
+    GPTModel that reuses its OpenAI clients. deepeval's GPTModel builds a new client,
+    and so a new connection pool, on every request.
+    """
+    def __init__(self, *args, **kwargs):
+        # set before GPTModel.__init__, which already loads the sync client
+        self._client = None
+        # async clients are bound to the event loop they were created in
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._client_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _get_limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                            max_keepalive_connections=MAX_CONNECTIONS,
+                            keepalive_expiry=KEEPALIVE_EXPIRY)
+
+    def load_model(self, async_mode: bool = False):
+        with self._client_lock:
+            if async_mode == False:
+                if self._client is None:
+                    self._client = OpenAI(api_key=self._openai_api_key, base_url=self.base_url,
+                                          http_client=httpx.Client(limits=self._get_limits()))
+                return self._client
+
+            loop = asyncio.get_running_loop()
+            if loop not in self._async_clients:
+                self._async_clients[loop] = AsyncOpenAI(api_key=self._openai_api_key, base_url=self.base_url,
+                                                        http_client=httpx.AsyncClient(limits=self._get_limits()))
+            return self._async_clients[loop]
+
+    async def aclose_async_client(self):
+        """Close the async client of the running event loop, before the loop ends"""
+        with self._client_lock:
+            client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+def get_judge_model(model: Optional[Union[str, DeepEvalBaseLLM]] = None) -> DeepEvalBaseLLM:
+    """
+    Return the process-wide judge model for a model name, so that every metric instance
+    and test case shares the same HTTP connection pool. Model instances are returned as is.
+    """
+    if isinstance(model, DeepEvalBaseLLM):
+        return model
+
+    with _lock:
+        if model not in _models:
+            judge, _ = initialize_model(model)
+            # other providers selected through the deepeval settings are kept as they are
+            if type(judge) is GPTModel:
+                judge = PooledGPTModel(model=model)
+            _models[model] = judge
+        return _models[model]
+
+
+def run_with_judge_models(main):
+    """
+    asyncio.run for a coroutine that measures with the judge models. The async clients
+    opened in its event loop are closed before the loop ends, instead of leaving one open
+    connection pool behind per run.
+    """
+    async def _main():
+        try:
+            return await main
+        finally:
+            with _lock:
+                models = [e for e in _models.values() if isinstance(e, PooledGPTModel)]
+            for model in models:
+                await model.aclose_async_client()
+
+    return asyncio.run(_main())
@@ -0,0 +1,120 @@
+import re
+import numpy as np
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+# same tokens as scikit-learn's default word tokenizer
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+# hashed n-gram space, large enough for collisions to be negligible
+N_FEATURES = 2 ** 22
+
+
+def _overlap(source_counts, summary_counts):
+    """
+    ROUGE style overlap between each source and its summary from their n-gram counts.
+    Returns the (precision, recall, f1) arrays over all pairs.
+    """
+    # clipped counts, as in ROUGE
+    overlap = np.asarray(source_counts.minimum(summary_counts).sum(axis=1), dtype=float).ravel()
+    source_total = np.asarray(source_counts.sum(axis=1), dtype=float).ravel()
+    summary_total = np.asarray(summary_counts.sum(axis=1), dtype=float).ravel()
+
+    precision = np.divide(overlap, summary_total, out=np.zeros_like(overlap), where=summary_total > 0)
+    recall = np.divide(overlap, source_total, out=np.zeros_like(overlap), where=source_total > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall,
+                   out=np.zeros_like(precision), where=(precision + recall) > 0)
+    return precision, recall, f1
+
+
+def _tfidf_cosine(source_counts, summary_counts) -> np.ndarray:
+    n = source_counts.shape[0]
+    vectors = TfidfTransformer(sublinear_tf=True).fit_transform(vstack([source_counts, summary_counts]).tocsr())
+    # rows are L2-normalized, so the row-wise dot product is the cosine similarity
+    return np.asarray(vectors[:n].multiply(vectors[n:]).sum(axis=1)).ravel()
+
+
+def _bigrams(tokens: list) -> list:
+    return [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+
+
+def compute_local_metrics(sources: list, summaries: list) -> dict:
+    """
+    Compute network-free summary metrics for all (source, summary) pairs at once.
+
+    Args:
+        sources (list): Original texts
+        summaries (list): Summaries, in the same order as the sources
+
+    Returns:
+        dict: Metric name to a numpy array with one value per pair
+    """
+    n = len(sources)
+
+    # tokenize every text once, and hash n-grams instead of building a vocabulary
+    tokens = [TOKEN_PATTERN.findall(text.lower()) for text in sources + summaries]
+    unigrams = HashingVectorizer(analyzer=lambda x: x, n_features=N_FEATURES,
+                                 alternate_sign=False, norm=None).transform(tokens)
+    bigrams = HashingVectorizer(analyzer=_bigrams, n_features=N_FEATURES,
+                                alternate_sign=False, norm=None).transform(tokens)
+
+    rouge1_p, rouge1_r, rouge1_f = _overlap(unigrams[:n], unigrams[n:])
+    rouge2_p, rouge2_r, rouge2_f = _overlap(bigrams[:n], bigrams[n:])
+
+    source_words = np.array([len(e) for e in tokens[:n]], dtype=float)
+    summary_words = np.array([len(e) for e in tokens[n:]], dtype=float)
+    compression_ratio = np.divide(summary_words, source_words,
+                                  out=np.zeros_like(summary_words), where=source_words > 0)
+
+    return {
+        'rouge1_precision': rouge1_p,
+        'rouge1_recall': rouge1_r,
+        'rouge1_f1': rouge1_f,
+        'rouge2_precision': rouge2_p,
+        'rouge2_recall': rouge2_r,
+        'rouge2_f1': rouge2_f,
+        'tfidf_cosine': _tfidf_cosine(unigrams[:n], unigrams[n:]),
+        'compression_ratio': compression_ratio,
+    }
+
+
+def get_local_scores(metrics: dict, weights: dict) -> np.ndarray:
+    """
+    Weighted average of the local metrics, in [0, 1].
+    """
+    total_weight = sum(weights.values())
+    score = sum(metrics[name] * weight for name, weight in weights.items())
+    return score / total_weight
+
+
+def prescreen(sources: list, summaries: list, config: dict) -> list:
+    """
+    Score all pairs with the local metrics and decide which ones still need the LLM judge.
+    Pairs scoring below LOW or above HIGH are settled locally, pairs in between or with
+    a compression ratio outside [MIN_COMPRESSION, MAX_COMPRESSION] go to the LLM judge.
+
+    Args:
+        sources (list): Original texts
+        summaries (list): Summaries, in the same order as the sources
+        config (dict): The LOCAL_METRICS config
+
+    Returns:
+        list: One dict per pair with the local metrics, the local score and the tier
+    """
+    if len(sources) == 0:
+        return []
+
+    metrics = compute_local_metrics(sources, summaries)
+    scores = get_local_scores(metrics, config['WEIGHTS'])
+
+    compression = metrics['compression_ratio']
+    unusual_compression = (compression < config['MIN_COMPRESSION']) | (compression > config['MAX_COMPRESSION'])
+    uncertain = ((scores >= config['LOW']) & (scores <= config['HIGH'])) | unusual_compression
+
+    results = []
+    for i in range(len(sources)):
+        results.append({
+            'tier': 'llm' if uncertain[i] else 'local',
+            'local_score': float(scores[i]),
+            'local_metrics': {name: float(values[i]) for name, values in metrics.items()},
+        })
+    return results
@@ -0,0 +1,175 @@
+import glob
+import json
+import os.path as osp
+import re
+import shutil
+import time
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITIONS = ['category', 'style']
+JUDGE_SCORE_COLUMNS = ['score', 'alignment_score', 'coverage_score', 'complex_coverage_score']
+SCORE_COLUMNS = JUDGE_SCORE_COLUMNS + ['local_score']
+
+
+def _count(verdicts, key, value):
+    return sum(1 for e in verdicts if str(e.get(key, '')).strip().lower() == value)
+
+
+def flatten_result(category, book, style, chunk_id, result):
+    """
+    Flatten the evaluation result of one chunk into a row of scores and verdict counts.
+    """
+    alignment_verdicts = result.get('alignment_verdicts', [])
+    coverage_verdicts = result.get('coverage_verdicts', [])
+    complex_coverage_verdicts = result.get('complex_coverage_verdicts', [])
+
+    tier = result.get('tier', 'llm')
+    row = {
+        'category': category,
+        'book': book,
+        'style': style,
+        'chunk_id': str(chunk_id),
+        'tier': tier,
+        'success': result.get('success'),
+        'error': result.get('error'),
+        'n_claims': len(result.get('claims', [])),
+        'n_alignment_yes': _count(alignment_verdicts, 'verdict', 'yes'),
+        'n_alignment_no': _count(alignment_verdicts, 'verdict', 'no'),
+        'n_alignment_idk': _count(alignment_verdicts, 'verdict', 'idk'),
+        'n_coverage_questions': len(coverage_verdicts),
+        'n_coverage_original_yes': _count(coverage_verdicts, 'original_verdict', 'yes'),
+        'n_coverage_summary_yes': _count(coverage_verdicts, 'summary_verdict', 'yes'),
+        'n_complex_questions': len(complex_coverage_verdicts),
+    }
+    for column in SCORE_COLUMNS:
+        row[column] = result.get(column)
+    # earlier versions also wrote the local score of locally settled chunks to 'score'
+    if tier == 'local':
+        for column in JUDGE_SCORE_COLUMNS:
+            row[column] = None
+    return row
+
+
+def load_eval_results(output_dir):
+    """
+    Read every outputs/{category}/{book}/eval_results_{style}.json file.
+
+    Returns:
+        tuple: (score rows, verbose log rows)
+    """
+    rows, log_rows = [], []
+    for path in sorted(glob.glob(osp.join(output_dir, '*', '*', 'eval_results_*.json'))):
+        match = re.match(r'eval_results_(.+)\.json$', osp.basename(path))
+        style = match.group(1)
+        # sampled runs only hold an estimate, not every chunk
+        if style.endswith('_sampled'):
+            continue
+        book_dir = osp.dirname(path)
+        book, category = osp.basename(book_dir), osp.basename(osp.dirname(book_dir))
+
+        with open(path, 'r') as f:
+            result_dict = json.load(f)
+
+        for chunk_id, result in result_dict.items():
+            rows.append(flatten_result(category, book, style, chunk_id, result))
+            log_rows.append({'category': category, 'book': book, 'style': style,
+                             'chunk_id': str(chunk_id), 'logs': json.dumps(result)})
+    return rows, log_rows
+
+
+def _write_dataset(rows, path):
+    if osp.exists(path):
+        shutil.rmtree(path)
+    table = pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False)
+    ds.write_dataset(table, path, format='parquet', partitioning=PARTITIONS, partitioning_flavor='hive')
+
+
+def ingest(output_dir, store_dir):
+    """
+    Rebuild the results store from the evaluation files of the whole library.
+    Scores go to {store_dir}/scores and verbose logs to {store_dir}/logs, both
+    partitioned by category and style.
+    """
+    start = time.time()
+    rows, log_rows = load_eval_results(output_dir)
+    if len(rows) == 0:
+        print(f'No evaluation results found in {output_dir}')
+        return
+
+    _write_dataset(rows, osp.join(store_dir, 'scores'))
+    _write_dataset(log_rows, osp.join(store_dir, 'logs'))
+    print(f'Ingested {len(rows)} chunks of {len({(e["category"], e["book"]) for e in rows})} books '
+          f'into {store_dir} in {time.time() - start:.2f}s')
+
+
+def load_scores(store_dir, columns=None, filters=None):
+    """
+    Load the score table, reading only the given columns and matching partitions.
+
+    Args:
+        filters (dict): Column to required value, e.g. {'style': 'analytic'}
+    """
+    dataset = ds.dataset(osp.join(store_dir, 'scores'), format='parquet', partitioning='hive')
+    expression = None
+    for column, value in (filters or {}).items():
+        condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def load_logs(store_dir, book, style):
+    """
+    Load the verbose logs of one book and style, keyed by chunk id.
+    """
+    dataset = ds.dataset(osp.join(store_dir, 'logs'), format='parquet', partitioning='hive')
+    table = dataset.to_table(filter=(ds.field('book') == book) & (ds.field('style') == style))
+    return {chunk_id: json.loads(logs) for chunk_id, logs in
+            zip(table.column('chunk_id').to_pylist(), table.column('logs').to_pylist())}
+
+
+def query(store_dir, group_by, metrics, agg='mean', filters=None):
+    """
+    Aggregate chunk scores across the library, e.g. the mean alignment score by category and style.
+    Unless filtered on a tier, results are also grouped by tier, so chunks settled by the local
+    metrics and chunks scored by the LLM judge are never aggregated together.
+    """
+    if 'tier' not in group_by and 'tier' not in (filters or {}):
+        group_by = group_by + ['tier']
+    scores = load_scores(store_dir, columns=list(dict.fromkeys(group_by + metrics)), filters=filters)
+    return scores.groupby(group_by, observed=True)[metrics].agg(agg)
+
+
+def parse_filters(filters):
+    return dict(e.split('=', 1) for e in filters or [])
+
+
+if __name__ == '__main__':
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Evaluation results store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='flatten every eval_results_{style}.json into the store')
+    ingest_parser.add_argument('--store_dir', type=str, default=config['RESULTS_STORE_DIR'], help='results store directory')
+    ingest_parser.add_argument('--output_dir', type=str, default=config['OUTPUT_DIR'], help='library output directory')
+
+    query_parser = subparsers.add_parser('query', help='aggregate chunk scores across the library')
+    query_parser.add_argument('--store_dir', type=str, default=config['RESULTS_STORE_DIR'], help='results store directory')
+    query_parser.add_argument('--by', type=str, nargs='+', default=['category', 'style'], help='columns to group by')
+    query_parser.add_argument('--metrics', type=str, nargs='+', default=['alignment_score'], help='columns to aggregate')
+    query_parser.add_argument('--agg', type=str, default='mean', help='pandas aggregation, e.g. mean, median, count')
+    query_parser.add_argument('--filter', type=str, nargs='*', default=None, help='column=value conditions')
+
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        ingest(args.output_dir, args.store_dir)
+    else:
+        start = time.time()
+        result = query(args.store_dir, args.by, args.metrics, agg=args.agg, filters=parse_filters(args.filter))
+        print(result.to_string())
+        print(f'\nQueried in {time.time() - start:.3f}s')
@@ -0,0 +1,170 @@
+import re
+import time
+import argparse
+from database import get_db_connection
+
+# stemmed, so that a query for "habit" also finds "habits"
+TOKENIZE = 'porter unicode61 remove_diacritics 2'
+
+# target: (index, indexed table, column referring to the text blob, view of the decompressed text, column)
+TARGETS = {
+    'summaries': ('chunk_summaries_fts', 'chunk_summaries', 'summary_hash', 'chunk_summary_texts', 'chunk_summary'),
+    'chunks': ('chunks_fts', 'chunks', 'text_hash', 'chunk_texts', 'chunk_text'),
+}
+
+
+def drop_outdated_search_index(conn):
+    """
+    Drop the indexes and triggers of earlier versions, which indexed the texts stored
+    inline in chunks and chunk_summaries instead of their blobs.
+    """
+    with conn:
+        for fts_table, table, _, view, _ in TARGETS.values():
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                               (fts_table,)).fetchone()
+            if row is not None and f"content='{view}'" not in row[0]:
+                for trigger in ('insert', 'delete', 'update'):
+                    conn.execute(f'DROP TRIGGER IF EXISTS {table}_fts_{trigger}')
+                conn.execute(f'DROP TABLE {fts_table}')
+
+
+def init_search_index(conn):
+    """
+    Create the full-text indexes over chunk texts and chunk summaries. Texts are only
+    stored once, compressed in blobs: the indexes read them through views and triggers
+    keep them in sync on every insert, update and delete, whichever process writes the rows.
+    """
+    drop_outdated_search_index(conn)
+
+    with conn:
+        for fts_table, table, hash_column, view, column in TARGETS.values():
+            exists = conn.execute('''
+                SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?
+            ''', (fts_table,)).fetchone() is not None
+
+            conn.execute(f'''
+                CREATE VIEW IF NOT EXISTS {view} AS
+                SELECT t.id AS id, decompress_text(b.data) AS {column}
+                FROM {table} t JOIN blobs b ON b.hash = t.{hash_column}
+            ''')
+            conn.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                    {column}, content='{view}', content_rowid='id', tokenize='{TOKENIZE}'
+                )
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts_table} (rowid, {column})
+                    SELECT new.id, decompress_text(data) FROM blobs WHERE hash = new.{hash_column};
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts_table} ({fts_table}, rowid, {column})
+                    SELECT 'delete', old.id, decompress_text(data) FROM blobs WHERE hash = old.{hash_column};
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF {hash_column} ON {table} BEGIN
+                    INSERT INTO {fts_table} ({fts_table}, rowid, {column})
+                    SELECT 'delete', old.id, decompress_text(data) FROM blobs WHERE hash = old.{hash_column};
+                    INSERT INTO {fts_table} (rowid, {column})
+                    SELECT new.id, decompress_text(data) FROM blobs WHERE hash = new.{hash_column};
+                END
+            ''')
+
+            # index the rows written before the index existed
+            if not exists:
+                conn.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+
+def get_fts_query(text):
+    """
+    Turn free text into an FTS5 query matching every word, so that punctuation and
+    words like AND, OR or NOT in the search box are not read as query syntax.
+    """
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', text))
+
+
+def search(conn, text, target='summaries', limit=20, highlight=('[', ']')):
+    """
+    Search chunk summaries or chunk texts, best matches first.
+
+    Args:
+        text (str): Words to search for
+        target (str): 'summaries' or 'chunks'
+        highlight (tuple): Markers put around the matched words in the snippet
+
+    Returns:
+        list: One dict per hit with the book, author, style, section title and snippet
+    """
+    query = get_fts_query(text)
+    if query == '':
+        return []
+
+    fts_table = TARGETS[target][0]
+    snippet = f"snippet({fts_table}, 0, ?, ?, '...', 16)"
+
+    if target == 'summaries':
+        # only the latest summary of each book and style, earlier ones were regenerated,
+        # and not the summaries of an earlier edition of the book
+        c = conn.execute(f'''
+            SELECT b.book_name, b.author, s.summary_style, cs.chunk_order, ch.chunk_title,
+                   {snippet}, bm25({fts_table})
+            FROM {fts_table}
+            JOIN chunk_summaries cs ON cs.id = {fts_table}.rowid
+            JOIN summaries s ON s.id = cs.summary_id
+            JOIN books b ON b.id = s.book_id
+            LEFT JOIN chunks ch ON ch.book_id = s.book_id AND ch.chunk_order = cs.chunk_order
+            WHERE {fts_table} MATCH ?
+              AND s.id IN (SELECT MAX(id) FROM summaries GROUP BY book_id, summary_style)
+              AND (s.content_hash IS NULL OR s.content_hash = b.content_hash)
+            ORDER BY bm25({fts_table})
+            LIMIT ?
+        ''', (*highlight, query, limit))
+    else:
+        c = conn.execute(f'''
+            SELECT b.book_name, b.author, NULL, ch.chunk_order, ch.chunk_title,
+                   {snippet}, bm25({fts_table})
+            FROM {fts_table}
+            JOIN chunks ch ON ch.id = {fts_table}.rowid
+            JOIN books b ON b.id = ch.book_id
+            WHERE {fts_table} MATCH ?
+            ORDER BY bm25({fts_table})
+            LIMIT ?
+        ''', (*highlight, query, limit))
+
+    return [{
+        'book': row[0],
+        'author': row[1],
+        'summary_style': row[2],
+        'chunk_order': row[3],
+        'title': row[4] or f'Section {row[3]}',
+        'snippet': row[5],
+        # bm25 is lower for better matches
+        'score': -row[6],
+    } for row in c.fetchall()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search the books and summaries of the app database")
+    parser.add_argument('query', type=str, help='words to search for')
+    parser.add_argument('--target', type=str, default='summaries', choices=list(TARGETS), help='what to search')
+    parser.add_argument('--limit', type=int, default=20, help='maximum number of hits')
+    parser.add_argument('--db_file', type=str, default='books.db', help='database of the app')
+
+    args = parser.parse_args()
+
+    conn = get_db_connection(args.db_file)
+    init_search_index(conn)
+
+    start = time.time()
+    hits = search(conn, args.query, target=args.target, limit=args.limit)
+    elapsed = time.time() - start
+    conn.close()
+
+    for hit in hits:
+        style = f" ({hit['summary_style']})" if hit['summary_style'] else ''
+        print(f"{hit['score']:.2f}  {hit['book']} - {hit['title']}{style}")
+        print(f"      {hit['snippet']}\n")
+    print(f'{len(hits)} hits in {elapsed * 1000:.1f}ms')
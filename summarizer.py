@@ -1,34 +1,293 @@
 import os
 import openai
 import json
-from utils import mkdir_if_not_exists
+from utils import mkdir_if_not_exists, count_tokens, get_text_hash, save_summary_file
 import os.path as osp
 from deepeval.test_case import LLMTestCase
 from deepeval.metrics import SummarizationMetric
+from judge_models import get_judge_model
 from document import PDF_Document
 from utils import save_txt_and_md_file
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class CandidateStopped(Exception):
+    """Raised in a candidate rewrite that is no longer needed, before its next API call"""
+
+
+class SourceCachedSummarizationMetric(SummarizationMetric):
+    """
+    SummarizationMetric for scoring several summaries of the same source text.
+    The truths and the source answers to the assessment questions are taken from
+    a previous measurement instead of being regenerated for every summary.
+    When a stop event is given, the measurement ends with CandidateStopped at the
+    next judge stage once the event is set.
+    """
+    def __init__(self, source_text: str, truths: list, original_answers: list, stop=None, **kwargs):
+        super().__init__(**kwargs)
+        self.source_text = source_text
+        self.source_truths = truths
+        self.original_answers = original_answers
+        self.stop = stop
+
+    def _check_stop(self):
+        if self.stop is not None and self.stop.is_set():
+            raise CandidateStopped()
+
+    @classmethod
+    def from_metric(cls, metric: SummarizationMetric, source_text: str):
+        return cls(source_text=source_text,
+                   truths=metric.truths,
+                   original_answers=[v.original_verdict for v in metric.coverage_verdicts],
+                   threshold=metric.threshold,
+                   model=metric.model,
+                   assessment_questions=metric.assessment_questions)
+
+    def _generate_truths(self, text):
+        return self.source_truths
+
+    async def _a_generate_truths(self, text):
+        return self.source_truths
+
+    def _generate_answers(self, text):
+        if text == self.source_text:
+            return self.original_answers
+        return super()._generate_answers(text)
+
+    async def _a_generate_answers(self, text):
+        if text == self.source_text:
+            return self.original_answers
+        self._check_stop()
+        return await super()._a_generate_answers(text)
+
+    async def _a_generate_claims(self, text):
+        self._check_stop()
+        return await super()._a_generate_claims(text)
+
+    async def _a_generate_alignment_verdicts(self):
+        self._check_stop()
+        return await super()._a_generate_alignment_verdicts()
+
+    async def _a_generate_reason(self):
+        self._check_stop()
+        return await super()._a_generate_reason()
 
 class Summarizer:
     def __init__(self, config):
         self.client = openai
         self.config = config
 
-    def _get_response(self, instruction, user_input):
-        response = self.client.chat.completions.create(
-            model='gpt-4o-mini',
+    def _get_completion(self, instruction, user_input, model='gpt-4o-mini', max_tokens=None):
+        kwargs = {}
+        if max_tokens is not None:
+            kwargs['max_tokens'] = max_tokens
+
+        return self.client.chat.completions.create(
+            model=model,
             messages=[
                 {"role": "system", "content": instruction},
                 {"role": "user", "content": user_input}
-            ]
+            ],
+            **kwargs
         )
+
+    def _get_response(self, instruction, user_input, model='gpt-4o-mini', max_tokens=None):
+        response = self._get_completion(instruction, user_input, model=model, max_tokens=max_tokens)
         return response.choices[0].message.content.strip()
+
+    def _route(self, text: str) -> dict:
+        """
+        Choose the model and the output token cap for a chunk from its token count
+        and the target compression ratio in the ROUTING config
+        """
+        routing = self.config['ROUTING']
+        input_tokens = count_tokens(text, routing['TOKENIZER'])
+
+        # rules are ordered by size, the first one that fits the chunk wins
+        model = routing['RULES'][-1]['model']
+        for rule in routing['RULES']:
+            if rule['max_input_tokens'] is None or input_tokens <= rule['max_input_tokens']:
+                model = rule['model']
+                break
+
+        max_tokens = int(input_tokens * routing['COMPRESSION_RATIO'])
+        max_tokens = max(max_tokens, routing['MIN_OUTPUT_TOKENS'])
+        max_tokens = min(max_tokens, routing['MAX_OUTPUT_TOKENS'])
+
+        return {
+            'model': model,
+            'input_tokens': input_tokens,
+            'max_tokens': max_tokens,
+            'retried': False
+        }
+
+    def _get_usage(self, response, model: str) -> dict:
+        prompt_tokens = response.usage.prompt_tokens
+        completion_tokens = response.usage.completion_tokens
+
+        # prompt tokens served from the provider's prompt cache
+        cached_tokens = 0
+        details = getattr(response.usage, 'prompt_tokens_details', None)
+        if details is not None and details.cached_tokens:
+            cached_tokens = details.cached_tokens
+
+        # pricing is given in USD per 1M tokens
+        pricing = self.config['PRICING'].get(model)
+        cost = None
+        cache_savings = None
+        if pricing is not None:
+            uncached_tokens = prompt_tokens - cached_tokens
+            cost = (uncached_tokens * pricing['input'] + cached_tokens * pricing['cached_input']
+                    + completion_tokens * pricing['output']) / 1e6
+            cache_savings = cached_tokens * (pricing['input'] - pricing['cached_input']) / 1e6
+
+        return {
+            'prompt_tokens': prompt_tokens,
+            'cached_tokens': cached_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'cost': cost,
+            'cache_savings': cache_savings
+        }
+
+    def _merge_usage(self, usage: dict, other: dict) -> dict:
+        if usage is None:
+            return dict(other)
+
+        merged = {}
+        for key in usage:
+            if usage[key] is None or other[key] is None:
+                merged[key] = None
+            else:
+                merged[key] = usage[key] + other[key]
+        return merged
+
+    def _get_routed_summary(self, text: str, summary_prompt: str, user_input: str = None, route: dict = None):
+        """
+        Summarize a chunk with the routed model and output cap.
+        If the cap truncates the summary, retry once with the maximum cap.
+        """
+        if user_input is None:
+            user_input = text
+        if route is None:
+            route = self._route(text)
+        max_output_tokens = self.config['ROUTING']['MAX_OUTPUT_TOKENS']
+
+        response = self._get_completion(instruction=summary_prompt, user_input=user_input,
+                                        model=route['model'], max_tokens=route['max_tokens'])
+        usage = self._get_usage(response, route['model'])
+
+        if response.choices[0].finish_reason == 'length' and route['max_tokens'] < max_output_tokens:
+            route['max_tokens'] = max_output_tokens
+            route['retried'] = True
+            response = self._get_completion(instruction=summary_prompt, user_input=user_input,
+                                            model=route['model'], max_tokens=route['max_tokens'])
+            usage = self._merge_usage(usage, self._get_usage(response, route['model']))
+
+        route['finish_reason'] = response.choices[0].finish_reason
+        summary = response.choices[0].message.content.strip()
+
+        return summary, route, usage
+
+    def _get_usage_report(self, summaries: dict) -> dict:
+        """
+        Aggregate per-chunk routing decisions and token usage of a book by model
+        """
+        report = {'chunks': {}, 'models': {}, 'total': None, 'reused': 0, 'regenerated': 0}
+
+        for chunk_id, chunk in summaries.items():
+            if 'usage' not in chunk:
+                continue
+            report['chunks'][chunk_id] = {'routing': chunk['routing'], 'usage': chunk['usage'],
+                                          'reused': chunk.get('reused', False)}
+
+            # reused chunks cost nothing in this run
+            if chunk.get('reused', False):
+                report['reused'] += 1
+                continue
+            report['regenerated'] += 1
+
+            model = chunk['routing']['model']
+            if model not in report['models']:
+                report['models'][model] = {'chunks': 0, 'usage': None}
+            report['models'][model]['chunks'] += 1
+            report['models'][model]['usage'] = self._merge_usage(report['models'][model]['usage'], chunk['usage'])
+
+            report['total'] = self._merge_usage(report['total'], chunk['usage'])
+
+        report['cache'] = self._get_cache_stats(report['total'])
+        for model in report['models']:
+            report['models'][model]['cache'] = self._get_cache_stats(report['models'][model]['usage'])
+
+        return report
+
+    def _get_cache_stats(self, usage: dict) -> dict:
+        if usage is None or usage['prompt_tokens'] == 0:
+            return {'hit_ratio': 0, 'savings': 0}
+
+        return {
+            'hit_ratio': usage['cached_tokens'] / usage['prompt_tokens'],
+            'savings': usage['cache_savings']
+        }
+
+    def _get_book_context(self, document: PDF_Document) -> str:
+        """
+        Per-book context sent after the static instruction, so the system prompt
+        stays a byte-stable prefix that the provider can cache across chunks
+        """
+        context = f"Book: {document.name}"
+        if document.author:
+            context += f"\nAuthor: {document.author}"
+        return context
+
+    def _get_user_input(self, text: str, title: str = None, context: str = None) -> str:
+        # book context first and section title next, so chunks of a book share the longest prefix
+        user_input = ''
+        if context:
+            user_input += f"{context}\n"
+        if title:
+            user_input += f"Section: {title}\n"
+        if user_input == '':
+            return text
+        return f"{user_input}\nSection text:\n{text}"
     
     def _load_prompt(self, file_path):
         with open(file_path, "r") as f:
             return f.read()
         
-    def _get_chunk_summaries(self, chunks: dict, summary_prompt: str) -> dict:
+    def _get_fingerprint(self, user_input: str, summary_prompt: str, prompt_file: str, model: str) -> dict:
+        """
+        Everything a chunk summary depends on. A chunk is only re-summarized when this changes.
+        """
+        return {
+            'input_hash': get_text_hash(user_input),
+            'prompt_file': prompt_file,
+            'prompt_hash': get_text_hash(summary_prompt),
+            'model': model
+        }
+
+    def _load_previous_summaries(self, summary_path: str) -> dict:
+        """
+        Index the chunks of an existing summary file by their fingerprint
+        """
+        if not osp.exists(summary_path):
+            return {}
+
+        with open(summary_path, 'r') as f:
+            previous = json.load(f)
+
+        index = {}
+        for chunk in previous.values():
+            if 'fingerprint' in chunk:
+                index[json.dumps(chunk['fingerprint'], sort_keys=True)] = chunk
+        return index
+
+    def _get_chunk_summaries(self, chunks: dict, summary_prompt: str, context: str = None,
+                             prompt_file: str = None, previous: dict = None) -> dict:
+        if previous is None:
+            previous = {}
+
         summaries = {}
         id = 0
         for chunk_id, chunk in chunks.items():
@@ -40,11 +299,25 @@ class Summarizer:
             if text == '':
                 chunk['summary'] = ''
             else:
-                summary = self._get_response(
-                    instruction=summary_prompt,
-                    user_input=text
-                )
-                chunk['summary'] = summary
+                user_input = self._get_user_input(text=text, title=chunk['title'], context=context)
+                route = self._route(text)
+                fingerprint = self._get_fingerprint(user_input, summary_prompt, prompt_file, route['model'])
+
+                # reuse the summary of an unchanged chunk from the previous run
+                previous_chunk = previous.get(json.dumps(fingerprint, sort_keys=True))
+                if previous_chunk is not None:
+                    chunk['summary'] = previous_chunk['summary']
+                    chunk['routing'] = previous_chunk['routing']
+                    chunk['usage'] = previous_chunk['usage']
+                    chunk['reused'] = True
+                else:
+                    summary, route, usage = self._get_routed_summary(text=text, summary_prompt=summary_prompt,
+                                                                     user_input=user_input, route=route)
+                    chunk['summary'] = summary
+                    chunk['routing'] = route
+                    chunk['usage'] = usage
+                    chunk['reused'] = False
+                chunk['fingerprint'] = fingerprint
             summaries[chunk_id] = chunk
 
             id += 1
@@ -94,26 +367,69 @@ class Summarizer:
 
         return toc + '\n\n' + content
     
-    def _get_doc_summary(self, document: PDF_Document, summary_prompt_path: str, save=True, summary_style: str = 'analytic') -> str:
+    def _get_chapters(self, chunks: dict) -> list:
+        """
+        Group chunks into top-level chapters: each chapter starts at a chunk of the
+        lowest level and holds the deeper chunks that follow it.
+        """
+        top_level = min((chunk['level'] for chunk in chunks.values()), default=0)
+
+        chapters = []
+        for chunk_id, chunk in chunks.items():
+            if len(chapters) == 0 or chunk['level'] == top_level:
+                chapters.append({})
+            chapters[-1][chunk_id] = chunk
+        return chapters
+
+    def _get_doc_summary(self, document: PDF_Document, summary_prompt_path: str, save=True, summary_style: str = 'analytic',
+                         incremental: bool = True, on_chapter=None) -> str:
+        """
+        Summarize every chunk of the document. With on_chapter, chunks are summarized
+        chapter by chapter and on_chapter(chapter_summaries) is called as each chapter
+        is done, so its summaries can be consumed while the next chapters are summarized.
+        """
         doc_contents = document.contents
         
         summary_prompt = self._load_prompt(summary_prompt_path)
 
-        final_summary = self._get_chunk_summaries(chunks=doc_contents, summary_prompt=summary_prompt)
-
         save_dir = document.save_dir
+        summary_path = osp.join(save_dir, f'summary_{summary_style}.json')
+
+        # only chunks whose input, prompt or model changed since the last run are re-summarized
+        previous = self._load_previous_summaries(summary_path) if incremental else {}
+
+        final_summary = {}
+        chapters = self._get_chapters(doc_contents) if on_chapter is not None else [doc_contents]
+        for chapter in chapters:
+            chapter_summaries = self._get_chunk_summaries(chunks=chapter, summary_prompt=summary_prompt,
+                                                          context=self._get_book_context(document),
+                                                          prompt_file=osp.basename(summary_prompt_path),
+                                                          previous=previous)
+            final_summary.update(chapter_summaries)
+            if on_chapter is not None:
+                on_chapter(chapter_summaries)
+
         # store save_dir
         self.save_dir = save_dir
 
         mkdir_if_not_exists(save_dir)
 
+        self.usage_report = self._get_usage_report(final_summary)
+        print(f"Reused {self.usage_report['reused']} chunks, regenerated {self.usage_report['regenerated']} chunks")
+        total = self.usage_report['total']
+        if total is not None:
+            print(f"Used {total['prompt_tokens']} prompt tokens and {total['completion_tokens']} completion tokens, cost: {total['cost']}")
+            print(f"Prompt cache hit ratio: {self.usage_report['cache']['hit_ratio']:.2%}, saved: {self.usage_report['cache']['savings']}")
+
         if save:
-            with open(osp.join(save_dir, f'summary_{summary_style}.json'), 'w') as f:
-                json.dump(final_summary, f, indent=2, ensure_ascii=False)
+            save_summary_file(summary_path, final_summary)
+
+            with open(osp.join(save_dir, f'usage_{summary_style}.json'), 'w') as f:
+                json.dump(self.usage_report, f, indent=2, ensure_ascii=False)
 
         return final_summary
     
-    def format_doc_summary(self, summary: dict, save=False) -> str:
+    def _format_chunks(self, summary: dict) -> str:
         formatted_summary = ""
         for _, chunk in summary.items():
             prefix = '#' * (chunk['level']+1)
@@ -122,6 +438,10 @@ class Summarizer:
                 formatted_summary += f"{prefix} {chunk['title']}\n\n"
             else:
                 formatted_summary += f"{prefix} {chunk['title']}\n\n{chunk['summary']}\n\n"
+        return formatted_summary
+
+    def format_doc_summary(self, summary: dict, save=False) -> str:
+        formatted_summary = self._format_chunks(summary)
 
         # add toc to the full summary
         formatted_summary = self._add_toc(formatted_summary)
@@ -134,11 +454,44 @@ class Summarizer:
         return formatted_summary
                     
     
+    def _get_reflect_input(self, input_text, summary, reason):
+        return f"""
+            Original Text:
+            {input_text}
+
+            Previous Summary:
+            {summary}
+
+            Score and Feedback:
+            {reason}
+            """
+
+    def _get_scored_candidate(self, input_text, self_reflect_prompt, reflect_input, evaluator, stop):
+        # each candidate gets its own metric instance, metrics keep per-measurement state
+        metric = SourceCachedSummarizationMetric(source_text=input_text,
+                                                 truths=evaluator.source_truths,
+                                                 original_answers=evaluator.original_answers,
+                                                 stop=stop,
+                                                 threshold=evaluator.threshold,
+                                                 model=evaluator.model,
+                                                 assessment_questions=evaluator.assessment_questions)
+
+        if stop.is_set():
+            raise CandidateStopped()
+        summary = self._get_response(instruction=self_reflect_prompt, user_input=reflect_input)
+        metric.measure(LLMTestCase(input=input_text, actual_output=summary), _show_indicator=False)
+
+        return summary, metric.score, metric.reason
+
     def _get_self_reflective_summary(self, input_text, summary_prompt_path,
                                     self_reflect_prompt_path,
-                                    max_attempts=5, threshold=0.7):
-
-        evaluator = SummarizationMetric(threshold=threshold, model="gpt-4o-mini")
+                                    max_attempts=5, threshold=0.7, n_candidates=1):
+        """
+        Rewrite the summary from the evaluator feedback until it scores above the threshold.
+        With n_candidates > 1, each round generates and scores n_candidates rewrites concurrently
+        and returns the first one over the threshold.
+        """
+        evaluator = SummarizationMetric(threshold=threshold, model=get_judge_model("gpt-4o-mini"))
 
         summary_prompt = self._load_prompt(summary_prompt_path)
         self_reflect_prompt = self._load_prompt(self_reflect_prompt_path)
@@ -167,40 +520,80 @@ class Summarizer:
             # if there are no questions yet
             if not questions:
                 questions = evaluator.assessment_questions
-                # adding questions to evaluator to avoid re-generating questions
-                evaluator = SummarizationMetric(threshold=threshold,
-                                                model="gpt-4o-mini",
-                                                assessment_questions=questions)
+                # reuse the questions, truths and source answers to avoid re-generating them
+                evaluator = SourceCachedSummarizationMetric.from_metric(evaluator, source_text=input_text)
                 print('QUESTIONS:', questions)
-            
-            
-            reflect_input = f"""
-            Original Text:
-            {input_text}
 
-            Previous Summary:
-            {best_summary}
-
-            Score and Feedback:
-            {reason}
-            """
+            reflect_input = self._get_reflect_input(input_text, best_summary, reason)
 
             print(f'ATTEMP {i+1}')
             print(f'SCORE: {score} \n REASON: {reason} \n SUMMARY: {summary}')
             print()
 
+            if n_candidates > 1:
+                return self._get_best_of_n_summary(input_text, self_reflect_prompt, reflect_input, evaluator,
+                                                   best_summary, best_score,
+                                                   max_attempts=max_attempts - i, n_candidates=n_candidates)
+
             # rewrite summary
             summary = self._get_response(instruction=self_reflect_prompt, user_input=reflect_input)
 
         return best_summary, best_score
+
+    def _get_best_of_n_summary(self, input_text, self_reflect_prompt, reflect_input, evaluator,
+                               best_summary, best_score, max_attempts, n_candidates):
+        attempts = 0
+        while attempts < max_attempts:
+            n = min(n_candidates, max_attempts - attempts)
+            attempts += n
+
+            best_reason = None
+            # set once a candidate passes: the others stop before their next API call,
+            # a call already in flight still completes and is paid for
+            stop = threading.Event()
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                futures = [executor.submit(self._get_scored_candidate, input_text, self_reflect_prompt,
+                                           reflect_input, evaluator, stop) for _ in range(n)]
+                try:
+                    for future in as_completed(futures):
+                        summary, score, reason = future.result()
+                        print(f'CANDIDATE SCORE: {score}')
+
+                        if score >= evaluator.threshold:
+                            return summary, score
+
+                        if score > best_score:
+                            best_score = score
+                            best_summary = summary
+                            best_reason = reason
+                finally:
+                    # leaving the pool waits for the running candidates to reach a stop check
+                    stop.set()
+
+            # next round starts from the best candidate so far
+            if best_reason is not None:
+                reflect_input = self._get_reflect_input(input_text, best_summary, best_reason)
+
+        return best_summary, best_score
         
 
+def get_summary_prompt_path(config: dict, summary_style: str) -> str:
+    assert summary_style in ['analytic', 'narrative', 'bullet_points'], "Invalid summary style"
+
+    if summary_style == 'analytic':
+        return osp.join(config["PROMPT_DIR"], "summary_cot_analytic_style.txt")
+    elif summary_style == 'narrative':
+        return osp.join(config["PROMPT_DIR"], "summary_cot_narrative_style.txt")
+    else:
+        return osp.join(config["PROMPT_DIR"], "summary_cot_bullet_points_style.txt")
+
 def main():
     openai.api_key = os.getenv("OPENAI_API_KEY")
 
     parser = argparse.ArgumentParser(description="Book summarizer")
     parser.add_argument('--style', type=str, default='analytic', help='summary style')
     parser.add_argument('--doc_path', type=str, default='datasets/books/Self-Development/Atomic Habits.pdf', help='document path')
+    parser.add_argument('--full', action='store_true', help='re-summarize every chunk instead of reusing unchanged ones')
     
     args = parser.parse_args()
 
@@ -212,19 +605,13 @@ def main():
     doc = PDF_Document(file_path=args.doc_path, config=config)
     
     summary_style = args.style
-    assert summary_style in ['analytic', 'narrative', 'bullet_points'], "Invalid summary style"
-
-    if summary_style == 'analytic':
-        summary_prompt_path = osp.join(config["PROMPT_DIR"], "summary_cot_analytic_style.txt")
-    elif summary_style == 'narrative':
-        summary_prompt_path = osp.join(config["PROMPT_DIR"], "summary_cot_narrative_style.txt")
-    else:
-        summary_prompt_path = osp.join(config["PROMPT_DIR"], "summary_cot_bullet_points_style.txt")
+    summary_prompt_path = get_summary_prompt_path(config, summary_style)
 
     summarizer._get_doc_summary(document=doc,
                             summary_prompt_path=summary_prompt_path,
                             save=True,
-                            summary_style=summary_style)
+                            summary_style=summary_style,
+                            incremental=not args.full)
     
     
     # self_reflect_prompt_path = osp.join(config['PROMPT_DIR'], 'self_reflect_cot.txt')
@@ -1,8 +1,61 @@
 import openai
-from utils import mkdir_if_not_exists
+from utils import mkdir_if_not_exists, count_tokens, split_by_tokens, get_text_hash
 import os.path as osp
 import json 
+import os
+import re
+import threading
+import time
+import mmap
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# MPEG audio layer III tables, indexed by the version bits of the frame header
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],    # MPEG-1
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],        # MPEG-2
+    0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],        # MPEG-2.5
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def get_mp3_duration(audio_content: bytes) -> float:
+    """
+    Duration in seconds of mp3 audio, from its frame headers. Works on concatenated
+    mp3 streams too, ID3 tags and unknown bytes are skipped.
+    """
+    duration = 0
+    i = 0
+    while i + 4 <= len(audio_content):
+        if audio_content[i:i + 3] == b'ID3' and i + 10 <= len(audio_content):
+            size = 0
+            for b in audio_content[i + 6:i + 10]:
+                size = (size << 7) | (b & 0x7F)
+            i += 10 + size
+            continue
+
+        b1, b2 = audio_content[i + 1], audio_content[i + 2]
+        version, layer = (b1 >> 3) & 3, (b1 >> 1) & 3
+        bitrate_index, sample_rate_index = b2 >> 4, (b2 >> 2) & 3
+        if (audio_content[i] != 0xFF or (b1 & 0xE0) != 0xE0 or version == 1 or layer != 1
+                or bitrate_index in (0, 15) or sample_rate_index == 3):
+            i += 1
+            continue
+
+        bitrate = MP3_BITRATES[version][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+        samples = 1152 if version == 3 else 576
+        duration += samples / sample_rate
+        i += samples // 8 * bitrate // sample_rate + ((b2 >> 1) & 1)
+    return duration
+
+def get_mp3_file_duration(path: str) -> float:
+    """
+    Duration in seconds of an mp3 file, read through a memory map instead of into memory.
+    """
+    if osp.getsize(path) == 0:
+        return 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as audio_content:
+        return get_mp3_duration(audio_content)
 
 class TextToSpeech:
     def __init__(self, config):
@@ -16,6 +69,7 @@ class TextToSpeech:
             "nova": "A bright and energetic voice",
             "shimmer": "A soft and gentle voice"
         }
+        self.tts_config = config['TTS']
 
     def _get_response(self, text: str, voice: str = "alloy") -> bytes:
         """
@@ -25,13 +79,234 @@ class TextToSpeech:
             raise ValueError(f"Voice {voice} not available. Choose from: {list(self.available_voices.keys())}")
 
         response = self.client.audio.speech.create(
-            model="gpt-4o-mini-tts",
+            model=self.tts_config['MODEL'],
             voice=voice,
             input=text
         )
         return response.content
 
-    def generate_speech(self, text: str, output_dir: str, voice: str = "alloy", save: bool = True) -> bytes:
+    def _iter_response(self, text: str, voice: str = "alloy", chunk_size: int = 4096):
+        """
+        Stream speech from OpenAI's TTS API, yielding the audio bytes as they arrive
+        """
+        if voice not in self.available_voices:
+            raise ValueError(f"Voice {voice} not available. Choose from: {list(self.available_voices.keys())}")
+
+        with self.client.audio.speech.with_streaming_response.create(
+            model=self.tts_config['MODEL'],
+            voice=voice,
+            input=text
+        ) as response:
+            yield from response.iter_bytes(chunk_size)
+
+    def _load_client(self):
+        # the module-level openai client is created on first use, threads racing to create it
+        # each get their own and the ones garbage collected close the connections of the others
+        self.client.audio.speech
+
+    def _split_text(self, text: str) -> list:
+        """
+        Split markdown text into spoken pieces below the TTS input limit. Pieces are cut at
+        headings first, and at sentence ends for sections longer than the limit.
+        Sections are never packed together, so editing one section leaves the
+        pieces, and the cached audio, of the other sections unchanged.
+        """
+        max_tokens = self.tts_config['MAX_INPUT_TOKENS']
+
+        pieces = []
+        for section in self._get_spoken_sections(text):
+            if count_tokens(section) <= max_tokens:
+                pieces.append(section)
+            else:
+                pieces.extend(split_by_tokens(section, max_tokens))
+        return pieces
+
+    def _get_spoken_text(self, section: str, is_first: bool) -> str:
+        """
+        Turn a markdown section into the text to read aloud: the heading becomes a spoken
+        transition, and links, images, emphasis, code and list markup are removed.
+        """
+        lines = section.split('\n')
+        heading = None
+        if lines[0].startswith('#'):
+            heading = lines[0].lstrip('#').strip()
+            lines = lines[1:]
+        body = '\n'.join(lines)
+
+        body = re.sub(r'!\[[^\]]*\]\([^)]*\)', '', body)            # images
+        body = re.sub(r'\[([^\]]*)\]\([^)]*\)', r'\1', body)          # links keep their text
+        body = re.sub(r'https?://\S+', '', body)                      # bare urls
+        body = re.sub(r'<[^>]+>', '', body)                            # html tags
+        body = re.sub(r'`{1,3}([^`]*)`{1,3}', r'\1', body)            # code
+        body = re.sub(r'(\*{1,3}|_{2,3})(\S.*?\S|\S)\1', r'\2', body)  # bold and italics
+        body = re.sub(r'^\s*([-*+]|\d+\.)\s+', '', body, flags=re.MULTILINE)   # list markers
+        body = re.sub(r'^\s*>\s?', '', body, flags=re.MULTILINE)                 # quotes
+        body = re.sub(r'^\s*([-*_]\s*){3,}$', '', body, flags=re.MULTILINE)      # horizontal rules
+        body = re.sub(r'[ \t]+', ' ', body)
+        body = re.sub(r'\n\s*\n+', '\n\n', body).strip()
+
+        if heading is None:
+            return body
+        heading = re.sub(r'[*_`]', '', heading).rstrip('.:')
+        transition = f'{heading}.' if is_first else f'Next section: {heading}.'
+        return f'{transition}\n\n{body}'.strip()
+
+    def _get_spoken_sections(self, text: str) -> list:
+        """
+        Split markdown text at headings into the sections to read aloud, without the
+        table of contents prepended to formatted summaries.
+        """
+        sections = []
+        for section in re.split(r'\n(?=#)', text):
+            section = section.strip()
+            if not section or re.match(r'#+\s*Table of Contents\s*$', section.split('\n')[0], re.IGNORECASE):
+                continue
+            spoken = self._get_spoken_text(section, is_first=len(sections) == 0)
+            if spoken:
+                sections.append(spoken)
+
+        n_spoken = sum(len(e) for e in sections)
+        print(f'Speech preprocessing: {len(text)} -> {n_spoken} characters '
+              f'({1 - n_spoken / max(len(text), 1):.1%} fewer)')
+        return sections
+
+    def _get_cache_path(self, text: str, voice: str) -> str:
+        # whitespace does not change the speech, so it does not change the key either
+        key = {
+            'model': self.tts_config['MODEL'],
+            'voice': voice,
+            'text': ' '.join(text.split()),
+        }
+        return osp.join(self.tts_config['CACHE_DIR'], get_text_hash(json.dumps(key, sort_keys=True)) + '.mp3')
+
+    def _load_cached_piece(self, text: str, voice: str) -> bytes:
+        path = self._get_cache_path(text, voice)
+        if not osp.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _iter_file(self, path: str, chunk_size: int = 4096):
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def _save_cached_piece(self, text: str, voice: str, audio_content: bytes):
+        for _ in self._iter_cached_piece_writes(text, voice, [audio_content]):
+            pass
+
+    def _iter_cached_piece_writes(self, text: str, voice: str, chunks):
+        """
+        Pass the audio bytes of a piece through while writing them to its cache file.
+        """
+        path = self._get_cache_path(text, voice)
+        mkdir_if_not_exists(osp.dirname(path))
+        # write then rename, so an interrupted run never leaves a partial piece, and
+        # threads synthesizing identical pieces do not share a temporary file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+        finally:
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _get_piece_response(self, text: str, voice: str, use_cache: bool = True) -> bytes:
+        """
+        Synthesize one piece, retrying it with exponential backoff on failure.
+        """
+        max_retries = self.tts_config['MAX_RETRIES']
+        for attempt in range(max_retries + 1):
+            try:
+                audio_content = self._get_response(text, voice)
+                if use_cache:
+                    self._save_cached_piece(text, voice, audio_content)
+                return audio_content
+            except openai.OpenAIError as e:
+                if attempt == max_retries:
+                    raise
+                print(f'Speech generation failed ({e}), retrying in {2 ** attempt}s')
+                time.sleep(2 ** attempt)
+
+    def _cache_piece(self, text: str, voice: str) -> str:
+        """
+        Stream one piece straight to its cache file, retrying it with exponential backoff
+        on failure.
+
+        Returns:
+            str: Path to the cached audio
+        """
+        max_retries = self.tts_config['MAX_RETRIES']
+        for attempt in range(max_retries + 1):
+            try:
+                for _ in self._iter_cached_piece_writes(text, voice, self._iter_response(text, voice)):
+                    pass
+                return self._get_cache_path(text, voice)
+            except openai.OpenAIError as e:
+                if attempt == max_retries:
+                    raise
+                print(f'Speech generation failed ({e}), retrying in {2 ** attempt}s')
+                time.sleep(2 ** attempt)
+
+    def _iter_piece_response(self, text: str, voice: str, use_cache: bool = True):
+        """
+        Stream one piece, writing it to the cache as it arrives. It is retried while no
+        bytes were yielded yet, a stream that breaks halfway cannot be taken back and raises.
+        """
+        max_retries = self.tts_config['MAX_RETRIES']
+        for attempt in range(max_retries + 1):
+            n_yielded = 0
+            try:
+                chunks = self._iter_response(text, voice)
+                if use_cache:
+                    chunks = self._iter_cached_piece_writes(text, voice, chunks)
+                for chunk in chunks:
+                    n_yielded += 1
+                    yield chunk
+                return
+            except openai.OpenAIError as e:
+                if attempt == max_retries or n_yielded > 0:
+                    raise
+                print(f'Speech generation failed ({e}), retrying in {2 ** attempt}s')
+                time.sleep(2 ** attempt)
+
+    def iter_speech(self, text: str, voice: str = "alloy", use_cache: bool = True):
+        """
+        Yield the audio bytes of the markdown text in order, as soon as they are available.
+        The first piece to generate is streamed, so playback can start after its first bytes,
+        while the later pieces are synthesized concurrently in the background. With the
+        cache, background pieces are streamed to their cache files and read back from
+        there, so no piece is held in memory as a whole.
+        """
+        pieces = self._split_text(text)
+        self._load_client()
+        cached = [use_cache and osp.exists(self._get_cache_path(piece, voice)) for piece in pieces]
+        missing = [i for i in range(len(pieces)) if not cached[i]]
+
+        executor = ThreadPoolExecutor(max_workers=self.tts_config['MAX_WORKERS'])
+        if use_cache:
+            futures = {i: executor.submit(self._cache_piece, pieces[i], voice) for i in missing[1:]}
+        else:
+            futures = {i: executor.submit(self._get_piece_response, pieces[i], voice, False) for i in missing[1:]}
+        try:
+            for i, piece in enumerate(pieces):
+                if cached[i]:
+                    yield from self._iter_file(self._get_cache_path(piece, voice))
+                elif i not in futures:
+                    yield from self._iter_piece_response(piece, voice, use_cache)
+                elif use_cache:
+                    yield from self._iter_file(futures[i].result())
+                else:
+                    yield futures[i].result()
+        finally:
+            # a consumer that stops early does not wait for the remaining pieces
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def generate_speech(self, text: str, output_dir: str, voice: str = "alloy", save: bool = True,
+                        use_cache: bool = True) -> bytes:
         """
         Generate speech from markdown text and optionally save to file
         
@@ -40,12 +315,30 @@ class TextToSpeech:
             output_dir (str): Directory to save the audio file
             voice (str): Voice to use for speech generation
             save (bool): Whether to save the audio file
+            use_cache (bool): Whether to reuse the audio of pieces synthesized before
             
         Returns:
             bytes: Audio content
         """
-        # Generate speech
-        audio_content = self._get_response(text, voice)
+        # Generate speech for every piece concurrently, and join the pieces in order
+        pieces = self._split_text(text)
+        audio_pieces = [None] * len(pieces)
+
+        # only the pieces without cached audio are sent to the API
+        if use_cache:
+            audio_pieces = [self._load_cached_piece(piece, voice) for piece in pieces]
+        missing = [i for i in range(len(pieces)) if audio_pieces[i] is None]
+        print(f'{len(pieces) - len(missing)} pieces reused from cache, {len(missing)} pieces to generate')
+
+        self._load_client()
+        with ThreadPoolExecutor(max_workers=self.tts_config['MAX_WORKERS']) as executor:
+            futures = {executor.submit(self._get_piece_response, pieces[i], voice, use_cache): i for i in missing}
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                audio_pieces[futures[future]] = future.result()
+                print(f'Generated speech for {n_done}/{len(missing)} pieces')
+
+        # mp3 streams are sequences of independent frames, so the pieces can be concatenated
+        audio_content = b''.join(audio_pieces)
         
         if save:
             # Create output directory if it doesn't exist
@@ -59,6 +352,24 @@ class TextToSpeech:
             
         return audio_content
 
+    def stream_speech(self, text: str, output_dir: str, voice: str = "alloy", use_cache: bool = True,
+                      file_name: str = None) -> str:
+        """
+        Generate speech from markdown text and write the audio bytes to file as they arrive,
+        without holding the whole clip in memory. The file is playable while it is written.
+
+        Returns:
+            str: Path to the audio file
+        """
+        mkdir_if_not_exists(output_dir)
+        output_path = osp.join(output_dir, file_name or f"speech_{voice}.mp3")
+        with open(output_path, "wb") as f:
+            for chunk in self.iter_speech(text, voice, use_cache=use_cache):
+                f.write(chunk)
+                f.flush()
+        print(f"Audio saved to {output_path}")
+        return output_path
+
     def list_available_voices(self) -> dict:
         """
         Return dictionary of available voices and their descriptions
@@ -68,6 +379,8 @@ class TextToSpeech:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Text to speech")
     parser.add_argument('--summary_path', type=str, required=True, help='path to summary file (.md or .txt format)')
+    parser.add_argument('--stream', action='store_true', help='write the audio to file as it is generated')
+    parser.add_argument('--no_cache', action='store_true', help='synthesize every piece again instead of reusing cached audio')
     
     args = parser.parse_args()
 
@@ -80,4 +393,7 @@ if __name__ == "__main__":
         text = f.read()
 
     mkdir_if_not_exists("outputs/speech")
-    text_to_speech.generate_speech(text=text, output_dir="outputs/speech", save=True)
+    if args.stream:
+        text_to_speech.stream_speech(text=text, output_dir="outputs/speech", use_cache=not args.no_cache)
+    else:
+        text_to_speech.generate_speech(text=text, output_dir="outputs/speech", save=True, use_cache=not args.no_cache)
@@ -3,6 +3,11 @@ import ebooklib
 from ebooklib import epub
 import os
 import re
+import json
+import zlib
+import hashlib
+import threading
+import tiktoken
 from collections import Counter
 
 class Cleaner:
@@ -113,6 +118,115 @@ def save_txt_and_md_file(path, content):
     with open(path, 'w') as f:
         f.write(content)
 
+def get_text_hash(text):
+    """
+    Return the SHA-256 hex digest of a text.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_file_hash(path, block_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def count_tokens(text, encoding_name='o200k_base'):
+    """
+    Count the number of tokens in a text with the given tiktoken encoding.
+    """
+    encoding = tiktoken.get_encoding(encoding_name)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def split_by_tokens(text, max_tokens, encoding_name='o200k_base'):
+    """
+    Split a text into windows of at most max_tokens tokens, cutting at paragraph or
+    sentence ends where possible.
+    """
+    encoding = tiktoken.get_encoding(encoding_name)
+    pieces = [e for e in re.split(r'(?<=[.!?])\s+|\n+', text) if e.strip()]
+
+    windows = []
+    current, current_tokens = [], 0
+    for piece in pieces:
+        tokens = encoding.encode(piece, disallowed_special=())
+        if current_tokens + len(tokens) > max_tokens and len(current) > 0:
+            windows.append(' '.join(current))
+            current, current_tokens = [], 0
+        if len(tokens) > max_tokens:
+            # a single piece too long for a window is cut at token boundaries
+            windows.extend(encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens))
+            continue
+        current.append(piece)
+        current_tokens += len(tokens)
+
+    if len(current) > 0:
+        windows.append(' '.join(current))
+    return windows
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'), 9)
+
+def decompress_text(data):
+    return zlib.decompress(data).decode('utf-8')
+
+def save_text_blob(blob_dir, text):
+    """
+    Store a text compressed under its hash, once however many files refer to it.
+
+    Returns:
+        str: Hash of the text
+    """
+    text_hash = get_text_hash(text)
+    path = os.path.join(blob_dir, f'{text_hash}.z')
+    if not os.path.exists(path):
+        os.makedirs(blob_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(compress_text(text))
+        os.replace(tmp_path, path)
+    return text_hash
+
+def load_text_blob(blob_dir, text_hash):
+    with open(os.path.join(blob_dir, f'{text_hash}.z'), 'rb') as f:
+        return decompress_text(f.read())
+
+def get_text_blob_dir(summary_path):
+    """Chunk texts of a book are shared by the summary files of all its styles"""
+    return os.path.join(os.path.dirname(summary_path), 'texts')
+
+def save_summary_file(summary_path, summary):
+    """
+    Save a summary_{style}.json file. Chunk texts are stored in the book's text blobs
+    and the file only keeps their hash.
+    """
+    blob_dir = get_text_blob_dir(summary_path)
+    stored = {}
+    for chunk_id, chunk in summary.items():
+        chunk = dict(chunk)
+        chunk['text_hash'] = save_text_blob(blob_dir, chunk.pop('text'))
+        stored[chunk_id] = chunk
+
+    with open(summary_path, 'w') as f:
+        json.dump(stored, f, indent=2, ensure_ascii=False)
+
+def load_summary_file(summary_path):
+    """
+    Load a summary_{style}.json file with the chunk texts, whether they are stored
+    inline, as in files written by earlier versions, or as text blobs.
+    """
+    with open(summary_path, 'r') as f:
+        summary = json.load(f)
+
+    blob_dir = get_text_blob_dir(summary_path)
+    for chunk in summary.values():
+        if 'text' not in chunk:
+            chunk['text'] = load_text_blob(blob_dir, chunk['text_hash'])
+    return summary
+
 def epub_to_text(epub_path):
     book = epub.read_epub(epub_path)
     text_content = []